@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import yaml
-import requests
 
 import json
+import os
+import sys
+import time
 import datetime
 import argparse
 import smtplib
@@ -18,7 +20,7 @@ import utils
 config = {}
 
 
-def initlog(level=None, log="-", disable_existing_loggers=True):
+def initlog(level=None, log="-", disable_existing_loggers=True, stream="ext://sys.stdout"):
     if level is None:
         level = logging.DEBUG if __debug__ else logging.INFO
     if isinstance(level, basestring):
@@ -64,7 +66,7 @@ def initlog(level=None, log="-", disable_existing_loggers=True):
         "class": "logging.StreamHandler",
         "level": "DEBUG",
         "formatter": "verbose",
-        "stream": "ext://sys.stdout"
+        "stream": stream
     }
     file_handler = {
         "class": "logging.handlers.RotatingFileHandler",
@@ -149,16 +151,194 @@ def update_cluster_settings(settings):
     global config
     logging.info("update cluster settings: %s" % settings)
     try:
-        url = u"{}/_cluster/settings".format(config["eshost"])
-        r = requests.put(
-            url, data=json.dumps(settings), params={
-                "master_timeout": "300s"}, headers={"content-type": "application/json"})
-        return r.ok
+        r = utils.request_with_retry(
+            utils.get_es_client(config["eshost"]), "PUT",
+            "_cluster/settings", data=json.dumps(settings), params={
+                "master_timeout": "300s"})
+        return r is not None and r.ok
     except Exception as e:
         logging.error("failed to update cluster settings. %s" % e)
         return False
 
 
+def _add_batch_results(action, results):
+    """
+    :type results: [([indexname], ok)]
+    """
+    failed = sorted(e for batch, ok in results if not ok for e in batch)
+    dopey_summary.add(
+        u"{}: {} batches, {} indices, {} failed{}".format(
+            action, len(results), sum(len(batch) for batch, _ in results),
+            len(failed), u"\n" + u"\n".join(failed) if failed else u""))
+
+
+def _add_merge_stats(merge_stats):
+    for indexname, seconds, segments_before, segments_after in merge_stats:
+        dopey_summary.add(
+            u"forcemerge {}: {:.1f}s, segments {} -> {}".format(
+                indexname, seconds, segments_before, segments_after))
+
+
+def _run_hooks(name):
+    """
+    :type name: setup or teardown
+    """
+    with utils.phase(name):
+        for action in config.get(name, []):
+            settings = action.values()[0]
+            eval(action.keys()[0])(settings)
+
+
+def process(plan, action_filters, inventory, journal=None, resumed=None):
+    """
+    prepare and execute the actions of plan one after another
+    :type plan: utils.Plan, could be None if resumed has prepared all the actions
+    :type journal: utils.Journal
+    :type resumed: the run loaded from the journal
+    :rtype: [([indexname], ok)]
+    """
+    rst = []
+    merge_stats = []
+    for action in utils.ACTIONS:
+        if action not in action_filters:
+            continue
+        with utils.phase(action):
+            groups = resumed and utils.Journal.remaining(resumed, action)
+            if groups is None:
+                to_process_indices = plan.get(action)
+                logging.info(u'try to {} `{}`'.format(action, ' '.join(e[0] for e in to_process_indices)))
+                groups = utils.prepare_action(config, action, to_process_indices, inventory)
+                if journal is not None:
+                    journal.prepared(action, groups)
+            else:
+                logging.info(u'resume {} `{}`'.format(
+                    action, ' '.join(e for _, indices in groups for e in indices)))
+            results = utils.execute_action(
+                config, action, groups, inventory, merge_stats,
+                journal, resumed and resumed["tasks"])
+        _add_batch_results(action, results)
+        rst.extend(results)
+    _add_merge_stats(merge_stats)
+    return rst
+
+
+def _send_sumary():
+    for name, hits, misses, size in utils.get_caches_stats():
+        dopey_summary.add(
+            u"cache {}: {} hits, {} misses, {} entries".format(name, hits, misses, size))
+    utils.clear_caches()
+
+    phases_stats = utils.get_phases_stats()
+    for e in phases_stats:
+        dopey_summary.add(_format_phase_stats(e))
+    _export_metrics(config.get("metrics") or {}, phases_stats)
+    utils.clear_phases()
+
+    sumary_config = config.get("sumary")
+    for action, kargs in sumary_config.items():
+        if kargs:
+            getattr(dopey_summary, action)(**kargs)
+        else:
+            getattr(dopey_summary, action)()
+    dopey_summary.records = []
+
+
+def _write_plan(plan_file, batches):
+    """
+    one json line per request: {"action", "indices", "settings", "shards"}
+    :type batches: [{}]
+    """
+    f = sys.stdout if plan_file == "-" else open(plan_file, "w")
+    try:
+        for batch in batches:
+            f.write(json.dumps(batch) + "\n")
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+def _read_plan(plan_file):
+    """
+    :rtype: {action: [([indexname], settings)]}, in the order of plan_file
+    """
+    batches = {}
+    with open(plan_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            batch = json.loads(line)
+            batches.setdefault(batch["action"], []).append(
+                (batch["indices"], batch.get("settings")))
+    return batches
+
+
+def _format_phase_stats(e):
+    line = u"phase {name}: {seconds:.1f}s, {requests} requests, {bytes_sent} bytes sent, " \
+        u"{bytes_received} bytes received, {retries} retries".format(**e)
+    if e["batches"]:
+        line += u", {batches} batches, latency p50 {latency_p50:.2f}s p90 {latency_p90:.2f}s " \
+            u"p99 {latency_p99:.2f}s max {latency_max:.2f}s".format(**e)
+    if e["throttle_waits"]:
+        line += u", throttled {throttle_waits} times for {throttle_seconds:.1f}s".format(**e)
+    return line
+
+
+def _write_atomic(path, content):
+    # textfile collectors may read the file at any time
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.rename(tmp, path)
+
+
+def _export_metrics(metrics_config, phases_stats):
+    """
+    :type metrics_config: {"json": path, "prometheus": path}
+    :type phases_stats: return of utils.get_phases_stats
+    """
+    now = time.time()
+    if metrics_config.get("json"):
+        try:
+            _write_atomic(metrics_config["json"], json.dumps(
+                {"timestamp": now, "phases": phases_stats}, indent=2))
+        except Exception as e:
+            logging.error(u"failed to write metrics json. {}".format(e))
+
+    if metrics_config.get("prometheus"):
+        lines = []
+        metrics = (
+            ("seconds", "wall time of the phase"),
+            ("requests", "http requests sent to elasticsearch"),
+            ("bytes_sent", "bytes of request bodies"),
+            ("bytes_received", "bytes of response bodies"),
+            ("retries", "retried requests"),
+            ("throttle_waits", "pauses of batches while the master was under pressure"),
+            ("throttle_seconds", "seconds batches were paused"),
+            ("batches", "batches sent"),
+        )
+        for key, doc in metrics:
+            lines.append(u"# HELP dopey_phase_{} {}".format(key, doc))
+            lines.append(u"# TYPE dopey_phase_{} gauge".format(key))
+            for e in phases_stats:
+                lines.append(u'dopey_phase_{}{{phase="{}"}} {}'.format(key, e["name"], e[key]))
+        lines.append(u"# HELP dopey_phase_batch_latency_seconds latency of batches")
+        lines.append(u"# TYPE dopey_phase_batch_latency_seconds summary")
+        for e in phases_stats:
+            if not e["batches"]:
+                continue
+            for q, key in (("0.5", "latency_p50"), ("0.9", "latency_p90"), ("0.99", "latency_p99"), ("1", "latency_max")):
+                lines.append(u'dopey_phase_batch_latency_seconds{{phase="{}",quantile="{}"}} {}'.format(
+                    e["name"], q, e[key]))
+        lines.append(u"# HELP dopey_last_run_timestamp_seconds time the last run finished")
+        lines.append(u"# TYPE dopey_last_run_timestamp_seconds gauge")
+        lines.append(u"dopey_last_run_timestamp_seconds {}".format(now))
+        try:
+            _write_atomic(metrics_config["prometheus"], u"\n".join(lines) + u"\n")
+        except Exception as e:
+            logging.error(u"failed to write metrics prometheus textfile. {}".format(e))
+
+
 def _get_base_day(base_day):
     try:
         int(base_day)
@@ -199,6 +379,104 @@ def pre_process_index_config(index_config):
     return index_config
 
 
+def _cycle(daemon_state, action_filters, base_day_offset, matcher):
+    """
+    one cycle of the daemon: look at the new indices, the indices whose age may have crossed
+    a rule and the failed indices whose backoff is over. everything is looked at again every `full_interval`
+    :type daemon_state: {"inventory", "wakeups", "failures", "full_at"}
+    """
+    options = config.get("daemon") or {}
+    poll_interval = float(options.get("poll_interval", 300))
+    full_interval = float(options.get("full_interval", 86400))
+    inventory = daemon_state["inventory"]
+    wakeups = daemon_state["wakeups"]
+    failures = daemon_state["failures"]
+    now = time.time()
+    base_day = datetime.datetime.now() + datetime.timedelta(base_day_offset)
+
+    with utils.phase('inventory'):
+        if now >= daemon_state["full_at"]:
+            inventory.clear()
+            wakeups.clear()
+            failures.clear()
+            for e in utils.get_indices(config):
+                inventory[e['index']] = e
+            due = set(inventory)
+            daemon_state["full_at"] = now + full_interval
+        else:
+            names = set(utils.get_index_names(config['eshost']))
+            for indexname in set(inventory) - names:
+                del inventory[indexname]
+                wakeups.pop(indexname, None)
+                failures.pop(indexname, None)
+            due = set(e for e in names if e not in inventory or
+                      (wakeups.get(e) is not None and wakeups[e] <= now))
+            for e in utils.get_indices(config, sorted(due)):
+                inventory[e['index']] = e
+            due &= set(inventory)
+    logging.info(u"{} indices, {} to evaluate".format(len(inventory), len(due)))
+
+    # looked at again after poll_interval if the cycle fails before they are processed
+    for indexname in due:
+        wakeups[indexname] = now + poll_interval
+
+    with utils.phase('planning'):
+        plan = utils.plan_actions(
+            config, [inventory[e] for e in sorted(due)], base_day, action_filters, matcher)
+        next_wakeups = {}
+        for indexname in due:
+            change = utils.get_next_evaluation(config, indexname, base_day, action_filters, matcher)
+            next_wakeups[indexname] = None if change is None else now + change.total_seconds()
+
+    if not any(plan.get(action) for action in action_filters):
+        wakeups.update(next_wakeups)
+        utils.clear_caches()
+        utils.clear_phases()
+        return
+
+    try:
+        _run_hooks("setup")
+        results = process(plan, action_filters, inventory)
+    finally:
+        # not to leave settings of setup like rebalance.enable: none behind a failed cycle
+        _run_hooks("teardown")
+    wakeups.update(next_wakeups)
+    _send_sumary()
+
+    for indices, ok in results:
+        for indexname in indices:
+            if ok:
+                failures.pop(indexname, None)
+                continue
+            # poll_interval after the first failure, doubled by every next one
+            failures[indexname] = failures.get(indexname, 0) + 1
+            retry_at = now + min(full_interval, poll_interval * 2 ** (failures[indexname] - 1))
+            if wakeups.get(indexname) is None or wakeups[indexname] > retry_at:
+                wakeups[indexname] = retry_at
+
+
+def run_daemon(action_filters, base_day_offset, matcher):
+    """
+    keep the config and the inventory in memory and sleep until the next index may need actions,
+    or `poll_interval` to find new indices
+    """
+    options = config.get("daemon") or {}
+    poll_interval = float(options.get("poll_interval", 300))
+    daemon_state = {"inventory": {}, "wakeups": {}, "failures": {}, "full_at": 0}
+    while True:
+        try:
+            _cycle(daemon_state, action_filters, base_day_offset, matcher)
+        except Exception as e:
+            logging.exception(u"daemon cycle failed. {}".format(e))
+        now = time.time()
+        wakeup = min([now + poll_interval, daemon_state["full_at"]] +
+                     [e for e in daemon_state["wakeups"].values() if e is not None])
+        logging.info(u"next cycle at {}".format(
+            datetime.datetime.fromtimestamp(wakeup).strftime("%Y-%m-%d %H:%M:%S")))
+        # at least 1 second, not to spin on indices failing again and again
+        time.sleep(max(1, wakeup - now))
+
+
 def main():
     global logging
 
@@ -218,75 +496,128 @@ def main():
         default="-",
         help="log file")
     parser.add_argument("--level", default="info")
+    parser.add_argument(
+        "--plan", nargs="?", const="-", default=None, metavar="FILE",
+        help="do not change anything, only write the requests to be sent as json lines to FILE. \
+        leaving FILE blank means stdout")
+    parser.add_argument(
+        "--apply-plan", default=None, metavar="FILE",
+        help="send the requests in FILE written by --plan, without scanning indices again")
+    parser.add_argument(
+        "--journal", default=None, metavar="FILE",
+        help="write prepared and done batches to FILE, overwrites journal in config file. not used with --apply-plan")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="continue the unfinished run in the journal, skipping the batches done. \
+        a new run is started if the last one has finished")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="keep running, look at indices again only when their age may cross a rule. \
+        base-day should be a number")
     args = parser.parse_args()
+    if args.daemon and (args.plan or args.apply_plan or args.resume):
+        parser.error("--daemon could not be used with --plan, --apply-plan or --resume")
+    if args.plan and args.apply_plan:
+        parser.error("--plan and --apply-plan are mutually exclusive")
+    if args.resume and (args.plan or args.apply_plan):
+        parser.error("--resume could not be used with --plan or --apply-plan")
 
     global config
     config = yaml.load(open(args.c))
     if args.eshost:
         config['eshost'] = args.eshost
+    utils.init_es_client(config)
+    utils.init_retry_policy(config)
+    matcher = utils.compile_index_patterns(config)
+    if config.get('cache_size') is not None:
+        utils.set_caches_size(int(config['cache_size']))
 
-    initlog(level=args.level, log=config["l"] if "log" in config else args.l)
-
-    all_indices = utils.get_indices(config['eshost'])
+    initlog(level=args.level, log=config["l"] if "log" in config else args.l,
+            stream="ext://sys.stderr" if args.plan == "-" else "ext://sys.stdout")
 
-    logging.debug(u"all_indices: {}".format(all_indices))
-
-    for action in config.get("setup", []):
-        settings = action.values()[0]
-        eval(action.keys()[0])(settings)
-
-    base_day = _get_base_day(args.base_day)
+    if args.daemon:
+        try:
+            base_day_offset = int(args.base_day)
+        except ValueError:
+            parser.error("--daemon needs a number as base-day")
+        run_daemon(_get_action_filters(args.action_filters), base_day_offset, matcher)
+        return
+
+    journal_path = args.journal or config.get("journal")
+    resumed = None
+    if args.resume:
+        if not journal_path:
+            parser.error("--resume needs --journal or journal in config file")
+        resumed = utils.Journal.load(journal_path)
+        if resumed is None:
+            logging.info(u"no unfinished run in {}, start a new one".format(journal_path))
+
+    if resumed is not None:
+        base_day = resumed["base_day"]
+        action_filters = resumed["action_filters"]
+        logging.info(u"resume the run in {}".format(journal_path))
+    else:
+        base_day = _get_base_day(args.base_day)
+        action_filters = _get_action_filters(args.action_filters)
     logging.info("base day is %s" % base_day)
-    action_filters = _get_action_filters(args.action_filters)
-
-    if 'delete_indices' in action_filters:
-        to_delete_indices = utils.get_to_delete_indices(
-            config, all_indices, base_day)
-        logging.info('try to delete `{}`'.format(' '.join(e[0] for e in to_delete_indices)))
-        utils.delete_indices(config, to_delete_indices)
-
-    if 'close_indices' in action_filters:
-        to_close_indices = utils.get_to_close_indices(
-            config, all_indices, base_day)
-        logging.info('try to close `{}`'.format(' '.join(e[0] for e in to_close_indices)))
-        utils.close_indices(config, to_close_indices)
-
-    if 'freeze_indices' in action_filters:
-        to_freeze_indices = utils.get_to_freeze_indices(
-            config, all_indices, base_day)
-        logging.info('try to freeze `{}`'.format(' '.join(e[0] for e in to_freeze_indices)))
-        utils.freeze_indices(config, to_freeze_indices)
-
-    if 'update_settings' in action_filters:
-        to_update_indices = utils.get_to_update_indices(
-            config, all_indices, base_day)
-        logging.info('(before settings diff filter)try to update `{}`'.format(' '.join(e[0] for e in to_update_indices)))
-        utils.update_settings(config, to_update_indices)
-
-    if 'optimize_indices' in action_filters:
-        to_optimize_indices = utils.get_to_optimize_indices(
-            config, all_indices, base_day)
-        logging.info('try to forcemerge `{}`'.format(' '.join(e[0] for e in to_optimize_indices)))
-        utils.optimize_indices(config, to_optimize_indices)
-
-    # dopey_summary.add(
-        # u"未处理:\n{}\n删除:\n{}\n关闭:\n{}\n优化:{}\n更新索配置:{}".format(
-        # "\n".join(sorted(not_dealt)),
-        # "\n".join(sorted(_delete)),
-        # "\n".join(sorted(_close)),
-        # "\n".join(sorted(_optimize)),
-        # "\n".join(sorted(_update_settings))))
-
-    for action in config.get("teardown", []):
-        settings = action.values()[0]
-        eval(action.keys()[0])(settings)
 
-    sumary_config = config.get("sumary")
-    for action, kargs in sumary_config.items():
-        if kargs:
-            getattr(dopey_summary, action)(**kargs)
-        else:
-            getattr(dopey_summary, action)()
+    plan = None
+    # a resumed run only plans the actions it had not started
+    to_plan_actions = [action for action in action_filters
+                       if resumed is None or action not in resumed["groups"]]
+    if args.apply_plan or not to_plan_actions:
+        # indices are not scanned again, the plan or the journal has decided them
+        inventory = None
+    else:
+        with utils.phase('inventory'):
+            all_indices = utils.get_indices(config)
+
+        logging.debug(u"all_indices: {}".format(' '.join(e['index'] for e in all_indices)))
+        inventory = dict((e['index'], e) for e in all_indices)
+
+        with utils.phase('planning'):
+            plan = utils.plan_actions(config, all_indices, base_day, action_filters, matcher)
+            if resumed is not None:
+                # planned with all the actions so that the started ones still supersede
+                plan = utils.Journal.unstarted(resumed, plan)
+
+    if args.plan:
+        # read only: no setup, teardown or sumary
+        _write_plan(args.plan, [
+            batch for action in utils.ACTIONS if action in action_filters
+            for batch in utils.plan_batches(
+                config, action,
+                utils.prepare_action(config, action, plan.get(action), inventory),
+                inventory)])
+        return
+
+    _run_hooks("setup")
+
+    if args.apply_plan:
+        batches = _read_plan(args.apply_plan)
+        merge_stats = []
+        for action in utils.ACTIONS:
+            if action not in action_filters:
+                continue
+            with utils.phase(action):
+                action_batches = batches.get(action, [])
+                logging.info(u'try to {} `{}` from plan'.format(
+                    action, ' '.join(e for batch, _ in action_batches for e in batch)))
+                _add_batch_results(action, utils.execute_batches(config, action, action_batches, merge_stats))
+        _add_merge_stats(merge_stats)
+    else:
+        journal = None
+        if journal_path:
+            journal = utils.Journal(journal_path).open()
+            if resumed is None:
+                journal.start(base_day, action_filters)
+        process(plan, action_filters, inventory, journal, resumed)
+        if journal is not None:
+            journal.finish()
+            journal.close()
+
+    _run_hooks("teardown")
+    _send_sumary()
 
 
 if __name__ == "__main__":
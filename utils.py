@@ -2,11 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import requests
+import requests.adapters
 
+import bisect
+import collections
+import contextlib
 import datetime
 import logging
+import math
+import os
+import random
 import re
 import json
+import threading
+import time
+import urllib
+import urlparse
+import Queue
+from multiprocessing.pool import ThreadPool
 
 
 def _compare_index_settings(part, whole):
@@ -24,456 +37,2216 @@ def _compare_index_settings(part, whole):
     >>> _compare_index_settings(part, whole)
     False
     """
-    if part == whole:
-        return True
-    if part is None and whole is None:
-        return True
-    if part is None or whole is None:
-        return (part, whole)
-    if not isinstance(part, type(whole)):
-        return (part, whole)
-    if not isinstance(part, dict):
-        return part == whole
-    for k, v in part.items():
-        r = _compare_index_settings(v, whole.get(k))
-        if r is not True:
+    return not _diff_index_settings(
+        _flatten_index_settings(part), _flatten_index_settings(whole))
+
+
+def _flatten_settings(settings, prefix=''):
+    """
+    type settings: nested dict
+    rtype: {dotted_key: value}
+    >>> sorted(_flatten_settings({"index": {"routing.allocation": {"require": {"boxtype": "weak"}}, "number_of_replicas": 1}}).items())
+    [(u'index.number_of_replicas', 1), (u'index.routing.allocation.require.boxtype', 'weak')]
+    """
+    rst = {}
+    for k, v in settings.items():
+        key = u"{}.{}".format(prefix, k) if prefix else k
+        if isinstance(v, dict):
+            rst.update(_flatten_settings(v, key))
+        else:
+            rst[key] = v
+    return rst
+
+
+def _normalize_settings_value(value):
+    """
+    elasticsearch returns all the settings as strings
+    >>> _normalize_settings_value(True), _normalize_settings_value(1), _normalize_settings_value(["a", 2])
+    (u'true', u'1', (u'a', u'2'))
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize_settings_value(e) for e in value)
+    return unicode(value)
+
+
+def _flatten_index_settings(settings):
+    """
+    flat dotted keys prefixed with `index.` and normalized values,
+    whether settings are nested, dotted or a mixture of them
+    >>> sorted(_flatten_index_settings({"number_of_replicas": 1, "index": {"routing.allocation": {"require": {"boxtype": "weak"}}}}).items())
+    [(u'index.number_of_replicas', u'1'), (u'index.routing.allocation.require.boxtype', u'weak')]
+    """
+    rst = {}
+    for k, v in _flatten_settings(settings or {}).items():
+        if not k.startswith('index.'):
+            k = u"index.{}".format(k)
+        rst[k] = _normalize_settings_value(v)
+    return rst
+
+
+def _diff_index_settings(flat_part, flat_whole):
+    """
+    type flat_part, flat_whole: {dotted_key: value}, from _flatten_index_settings
+    rtype: {dotted_key: (value in part, value in whole)} of all the differing keys
+    >>> _diff_index_settings({"index.a": u"1", "index.b": u"2"}, {"index.a": u"1", "index.b": u"3", "index.c": u"4"})
+    {'index.b': (u'2', u'3')}
+    """
+    # a missing key equals None, the value to reset a setting
+    return dict((k, (v, flat_whole.get(k)))
+                for k, v in set(flat_part.items()) - set(flat_whole.items())
+                if v != flat_whole.get(k))
+
+
+class EsClient(object):
+    """
+    all the requests to one eshost go through one pooled, keep-alive session.
+    user:password in eshost is taken out once and used as basic auth
+    """
+
+    def __init__(self, eshost, pool_size=10, timeout=300):
+        super(EsClient, self).__init__()
+        parsed = urlparse.urlsplit(eshost)
+        netloc = parsed.netloc.rpartition('@')[2]
+        self.eshost = urlparse.urlunsplit(
+            (parsed.scheme, netloc, parsed.path.rstrip('/'), '', ''))
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        if parsed.username is not None:
+            self.session.auth = (
+                urlparse.unquote(parsed.username),
+                urlparse.unquote(parsed.password or ''))
+        self.session.headers.update({"content-type": "application/json"})
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path):
+        return u"{}/{}".format(self.eshost, path.lstrip('/'))
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        _record('requests', 1)
+        _record('bytes_sent', len(kwargs.get('data') or ''))
+        r = self.session.request(method, self.url(path), **kwargs)
+        _record('bytes_received', len(r.content))
+        return r
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+
+class PhaseMetrics(object):
+    """
+    wall time, http requests, bytes, retries, throttle waits and batch latencies of one phase of a run
+    """
+
+    def __init__(self, name):
+        super(PhaseMetrics, self).__init__()
+        self.name = name
+        self.seconds = 0.0
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.throttle_waits = 0
+        self.throttle_seconds = 0.0
+        self.latencies = []
+
+
+_phases = collections.OrderedDict()
+_phases_stack = []
+_phases_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    requests, retries and batches during the block are counted to the innermost phase.
+    worker threads of run_batches count to the phase that started them
+    """
+    with _phases_lock:
+        if name not in _phases:
+            _phases[name] = PhaseMetrics(name)
+        _phases_stack.append(_phases[name])
+    start = time.time()
+    try:
+        yield _phases[name]
+    finally:
+        with _phases_lock:
+            _phases[name].seconds += time.time() - start
+            _phases_stack.pop()
+
+
+def _record(attr, value):
+    with _phases_lock:
+        if not _phases_stack:
+            return
+        m = _phases_stack[-1]
+        if attr == 'latencies':
+            m.latencies.append(value)
+        else:
+            setattr(m, attr, getattr(m, attr) + value)
+
+
+def _percentile(values, p):
+    """
+    nearest rank
+    >>> _percentile([4, 1, 3, 2], 50)
+    2
+    >>> _percentile([4, 1, 3, 2], 99)
+    4
+    """
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def get_phases_stats():
+    """
+    rtype: [{name, seconds, requests, bytes_sent, bytes_received, retries, throttle_waits,
+            throttle_seconds, batches,
+            latency_p50, latency_p90, latency_p99, latency_max}], latencies are None without batches
+    """
+    rst = []
+    with _phases_lock:
+        for m in _phases.values():
+            e = {
+                "name": m.name,
+                "seconds": m.seconds,
+                "requests": m.requests,
+                "bytes_sent": m.bytes_sent,
+                "bytes_received": m.bytes_received,
+                "retries": m.retries,
+                "throttle_waits": m.throttle_waits,
+                "throttle_seconds": m.throttle_seconds,
+                "batches": len(m.latencies),
+            }
+            for p in (50, 90, 99):
+                e["latency_p%d" % p] = _percentile(m.latencies, p) if m.latencies else None
+            e["latency_max"] = max(m.latencies) if m.latencies else None
+            rst.append(e)
+    return rst
+
+
+def clear_phases():
+    with _phases_lock:
+        _phases.clear()
+
+
+_es_clients = {}
+_es_clients_lock = threading.Lock()
+
+
+def init_es_client(config):
+    """
+    (re)create the client of config['eshost'] with `pool_size` and `timeout` in config
+    rtype: EsClient
+    """
+    client = EsClient(
+        config['eshost'],
+        pool_size=config.get('pool_size', 10),
+        timeout=config.get('timeout', 300))
+    with _es_clients_lock:
+        _es_clients[config['eshost']] = client
+    return client
+
+
+def get_es_client(eshost):
+    """
+    rtype: EsClient, created with default options if init_es_client was not called
+    """
+    with _es_clients_lock:
+        client = _es_clients.get(eshost)
+        if client is None:
+            client = _es_clients[eshost] = EsClient(eshost)
+        return client
+
+
+class RetryPolicy(object):
+    """
+    exponential backoff with full jitter between attempts. connection errors and
+    overloaded or timed out responses are retried, other errors are not.
+    retries of the whole run take from one budget
+    """
+
+    RETRYABLE_STATUS = frozenset([408, 429, 502, 503, 504])
+
+    def __init__(self, backoff=1, backoff_max=60, budget=None):
+        super(RetryPolicy, self).__init__()
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.budget = budget
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def retryable(self, r):
+        """
+        :type r: response, None if the request raised
+        """
+        return r is None or r.status_code in self.RETRYABLE_STATUS
+
+    def acquire(self):
+        """
+        rtype: boolean, False once the budget is used up
+        """
+        with self._lock:
+            if self.budget is not None and self.used >= self.budget:
+                return False
+            self.used += 1
+            return True
+
+    def wait(self, attempt, r=None):
+        """
+        sleep before the attempt-th retry, at least as long as Retry-After of r
+        """
+        seconds = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** (attempt - 1)))
+        if r is not None:
+            try:
+                seconds = max(seconds, float(r.headers.get('Retry-After') or 0))
+            except ValueError:
+                pass
+        time.sleep(seconds)
+
+
+_retry_policy = RetryPolicy()
+
+
+def init_retry_policy(config):
+    """
+    `retry_backoff`, `retry_backoff_max` and `retry_budget` in config
+    rtype: RetryPolicy
+    """
+    global _retry_policy
+    budget = config.get('retry_budget')
+    _retry_policy = RetryPolicy(
+        backoff=float(config.get('retry_backoff', 1)),
+        backoff_max=float(config.get('retry_backoff_max', 60)),
+        budget=None if budget is None else int(budget))
+    return _retry_policy
+
+
+def request_with_retry(client, method, path, retry=3, **kwargs):
+    """
+    send a request, up to `retry` attempts under the retry policy
+    rtype: the last response, None if no attempt got a response
+    """
+    r = None
+    for attempt in range(retry):
+        if attempt:
+            if not _retry_policy.acquire():
+                logging.warn(u"retry budget is used up, {} {} is not retried".format(method, path))
+                break
+            _record('retries', 1)
+            _retry_policy.wait(attempt, r)
+        try:
+            r = client.request(method, path, **kwargs)
+        except requests.exceptions.RequestException as e:
+            logging.warn(u"{} {} failed. {}".format(method, client.url(path), e))
+            r = None
+            continue
+        if r.ok or not _retry_policy.retryable(r):
             return r
-    return True
+        logging.warn(u"{} {} failed with {}. {}".format(method, client.url(path), r.status_code, r.text))
+    return r
 
 
-def get_indices(eshost):
-    all_indices = []
-    url = "{}/_cat/indices?h=i".format(eshost)
-    logging.debug(u"get all indices from {}".format(url))
+def _int_or_none(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def _get_frozen_indices(client, indices="_all"):
+    """
+    _cat/indices has no frozen column, so take index.frozen of all indices in one request
+    type indices: comma joined index names
+    rtype: set([indexname])
+    """
+    try:
+        r = client.get(
+            u"{}/_settings/index.frozen".format(indices),
+            params={"filter_path": "*.settings.index.frozen", "ignore_unavailable": "true"})
+        if not r.ok:
+            raise Exception(r.text)
+        return set(indexname for indexname, e in (r.json() or {}).items()
+                   if str(e['settings']['index'].get('frozen')).lower() == 'true')
+    except Exception as e:
+        logging.warn(u"could not get frozen indices: {}".format(e))
+        return set()
 
-    r = requests.get(url, headers={"content-type": "application/json"})
+
+def get_index_names(eshost):
+    """
+    rtype: [indexname], the cheapest listing of all indices
+    """
+    client = get_es_client(eshost)
+    r = client.get("_cat/indices", params={"format": "json", "h": "index"})
     if not r.ok:
         logging.error(r.text)
-        raise BaseException(u"could not get indices from {}:{}".format(url, r.status_code))
-    for i in r.text.split():
-        i = i.strip()
-        if i == "":
-            continue
-        all_indices.append(i)
+        raise BaseException(u"could not get indices from {}:{}".format(client.url("_cat/indices"), r.status_code))
+    return [row["index"] for row in r.json()]
+
+
+# query params of _cat/indices in get_indices
+_INDICES_PARAMS = {
+    "format": "json",
+    "bytes": "b",
+    "h": "index,health,status,pri,rep,docs.count,store.size,sc,creation.date"}
+
+
+def get_indices(config, indices=None):
+    """
+    type indices: [indexname], only these indices if given, in requests of at most
+        `max_url_length`. missing ones are left out
+    rtype: [{"index", "health", "status", "frozen", "pri", "rep", "docs_count",
+             "store_size", "segments_count", "creation_date"}]
+    status is open or close, store_size in bytes, creation_date in epoch millis.
+    stats of closed indices are None
+    """
+    eshost = config['eshost']
+    if indices is not None:
+        # the frozen request has shorter params than _cat/indices, both fit
+        max_path_bytes = _get_max_path_bytes(config, dict(_INDICES_PARAMS, ignore_unavailable="true"))
+        all_indices = []
+        for to_get_indices in Batcher(100, max_path_bytes=max_path_bytes).split(indices):
+            all_indices.extend(_get_indices(eshost, ','.join(to_get_indices)))
+        return all_indices
+    return _get_indices(eshost)
+
+
+def _get_indices(eshost, indices=None):
+    all_indices = []
+    client = get_es_client(eshost)
+    path = "_cat/indices" if indices is None else u"_cat/indices/{}".format(indices)
+    logging.debug(u"get indices from {}".format(client.url(path)))
+
+    params = dict(_INDICES_PARAMS)
+    if indices is not None:
+        params["ignore_unavailable"] = "true"
+    r = client.get(path, params=params)
+    if not r.ok:
+        logging.error(r.text)
+        raise BaseException(u"could not get indices from {}:{}".format(client.url(path), r.status_code))
+
+    frozen_indices = _get_frozen_indices(client, indices or "_all")
+    for row in r.json():
+        all_indices.append({
+            "index": row["index"],
+            "health": row.get("health"),
+            "status": row.get("status"),
+            "frozen": row["index"] in frozen_indices,
+            "pri": _int_or_none(row.get("pri")),
+            "rep": _int_or_none(row.get("rep")),
+            "docs_count": _int_or_none(row.get("docs.count")),
+            "store_size": _int_or_none(row.get("store.size")),
+            "segments_count": _int_or_none(row.get("sc")),
+            "creation_date": _int_or_none(row.get("creation.date")),
+        })
     return all_indices
 
 
-def cache(c):
-    def wrapper(func):
-        def inner(*args):
-            r = c.get(tuple(args))
-            if r:
-                return r
-            r = func(*args)
-            c[tuple(args)] = r
-            return r
-        return inner
-    return wrapper
+_MISSING = object()
 
 
-@cache(c={})
-def get_index_settings(eshost, indexname):
-    url = u"{}/{}/_settings".format(eshost, indexname)
-    try:
-        return requests.get(url, headers={"content-type": "application/json"}).json()[indexname]['settings']
-    except Exception as e:
-        logging.error(
-            u"could not get {} settings: {}".format(
-                indexname, str(e)))
-        return {}
-
-
-@cache(c={})
-def pick_date_from_indexname(indexname, index_prefix):
-    patterns = (
-        (r"^%s(\d{4}\.\d{2}\.\d{2})$", "%Y.%m.%d"),
-        (r"^%s(\d{4}\-\d{2}\-\d{2})$", "%Y-%m-%d"),
-        (r"^%s(\d{4}\.\d{2})$", "%Y.%m"),
-        (r"^%s(\d{4}\-\d{2})$", "%Y-%m"),
-    )
-    for pattern_format, date_format in patterns:
-        r = re.findall(
-            pattern_format % index_prefix,
-            indexname)
-        if r:
-            date = datetime.datetime.strptime(r[0], date_format)
-            return date
-
-    index_format = index_prefix
-    r = re.findall(u'\(\?P<date>([^)]+)\)', index_format)
-    if len(r) != 1:
-        return
-    date_format = r[0]
-
-    index_format = index_format.replace('%Y', r'\d{4}')
-    index_format = index_format.replace('%y', r'\d{2}')
-    index_format = index_format.replace('%m', r'\d{2}')
-    index_format = index_format.replace('%d', r'\d{2}')
-    index_format = index_format.replace('%H', r'\d{2}')
-    index_format = index_format.replace('%M', r'\d{2}')
-    index_format = index_format.replace('.', r'\.')
-
-    r = re.findall(index_format, indexname)
-    if r:
-        date = datetime.datetime.strptime(r[0], date_format)
-        return date
-
-
-def get_to_process_indices(to_select_action, config, all_indices, base_day):
-    """
-    rtype: [(indexname, index_settings, dopey_index_settings)]
+class Memo(object):
     """
-    rst = []
+    memoized results of one function with hit and miss counters. None is memoized too.
+    all the entries are dropped at once when maxsize is reached, cheaper on the hot path
+    than keeping the least recently used order
+    >>> m = Memo('m', maxsize=2)
+    >>> m.get('a') is _MISSING
+    True
+    >>> m.set('a', None); m.set('b', 2)
+    >>> m.get('a'), m.get('b'), m.hits, m.misses
+    (None, 2, 2, 1)
+    >>> m.set('c', 3); len(m)
+    1
+    """
+
+    def __init__(self, name, maxsize=None):
+        super(Memo, self).__init__()
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """
+        rtype: memoized value or _MISSING
+        """
+        try:
+            r = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return _MISSING
+        self.hits += 1
+        return r
+
+    def set(self, key, value):
+        if self.maxsize is not None and len(self._data) >= self.maxsize:
+            self._data.clear()
+        self._data[key] = value
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+_caches = []
+
+
+def set_caches_size(maxsize):
+    for c in _caches:
+        c.maxsize = maxsize
+
+
+def clear_caches():
+    """
+    forget the memoized values and reset the counters, after every run and every daemon cycle
+    """
+    for c in _caches:
+        c.clear()
+
+
+def get_caches_stats():
+    """
+    rtype: [(name, hits, misses, size)]
+    """
+    return [(c.name, c.hits, c.misses, len(c)) for c in _caches]
+
+
+def get_indices_settings(config, indices, keys=None):
+    """
+    fetch settings of many indices with comma joined names, `settings_batch` names per request
+    type indices: [indexname]
+    type keys: [dotted_key] or None, only these settings are returned if given
+    rtype: {indexname: index_settings}, indices having none of the keys are left out
+    """
+    params = {"ignore_unavailable": "true"}
+    if keys:
+        params["filter_path"] = ",".join(
+            u"*.settings.{}".format(k) for k in sorted(keys))
+    batcher = Batcher(
+        config.get('settings_batch', 100),
+        max_path_bytes=_get_max_path_bytes(config, params))
+
+    client = get_es_client(config['eshost'])
+    rst = {}
+    for to_get_indices in batcher.split(indices):
+        path = u"{}/_settings".format(','.join(to_get_indices))
+        logging.debug(u"get settings: {}".format(client.url(path)))
+        try:
+            r = client.get(path, params=params)
+            if not r.ok:
+                raise Exception(r.text)
+            for indexname, e in r.json().items():
+                rst[indexname] = e['settings']
+        except Exception as e:
+            logging.error(
+                u"could not get {} settings: {}".format(
+                    ','.join(to_get_indices), str(e)))
+    return rst
+
+
+_DATE_PATTERNS = (
+    (r"^%s(\d{4}\.\d{2}\.\d{2})$", "%Y.%m.%d"),
+    (r"^%s(\d{4}\-\d{2}\-\d{2})$", "%Y-%m-%d"),
+    (r"^%s(\d{4}\.\d{2})$", "%Y.%m"),
+    (r"^%s(\d{4}\-\d{2})$", "%Y-%m"),
+)
+
+_REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+_DIGITS = frozenset('0123456789')
+
+
+def _get_date_format(suffix):
+    """
+    tell the built-in date format of suffix by its length and separators, no regex
+    rtype: one of the formats in _DATE_PATTERNS, or None
+    >>> _get_date_format('2019.01.31')
+    '%Y.%m.%d'
+    >>> _get_date_format('2019-01')
+    '%Y-%m'
+    >>> _get_date_format('2019.01-31') is None
+    True
+    """
+    if len(suffix) == 10:
+        digits = suffix[:4] + suffix[5:7] + suffix[8:]
+        if suffix[4] != suffix[7]:
+            return None
+    elif len(suffix) == 7:
+        digits = suffix[:4] + suffix[5:]
+    else:
+        return None
+    if suffix[4] not in '.-' or not _DIGITS.issuperset(digits):
+        return None
+    return '%Y{0}%m{0}%d'.format(suffix[4]) if len(suffix) == 10 else '%Y{0}%m'.format(suffix[4])
+
+
+# parsed dates by (date string, format) and by the whole suffix after a plain text prefix.
+# indices of one day share them
+_dates = Memo('dates')
+_suffix_dates = Memo('suffix_dates')
+_caches.extend([_dates, _suffix_dates])
+
+
+def _parse_date(date_string, date_format):
+    """
+    the built-in formats are sliced, others go to strptime
+    >>> _parse_date('2019.01.31', '%Y.%m.%d')
+    datetime.datetime(2019, 1, 31, 0, 0)
+    >>> _parse_date('2019-02', '%Y-%m')
+    datetime.datetime(2019, 2, 1, 0, 0)
+    """
+    key = (date_string, date_format)
+    rst = _dates.get(key)
+    if rst is not _MISSING:
+        return rst
+    if date_format in ('%Y.%m.%d', '%Y-%m-%d'):
+        rst = datetime.datetime(int(date_string[:4]), int(date_string[5:7]), int(date_string[8:10]))
+    elif date_format in ('%Y.%m', '%Y-%m'):
+        rst = datetime.datetime(int(date_string[:4]), int(date_string[5:7]), 1)
+    else:
+        rst = datetime.datetime.strptime(date_string, date_format)
+    _dates.set(key, rst)
+    return rst
+
+
+def _pick_suffix_date(suffix):
+    """
+    rtype: datetime.datetime if suffix is a date of the built-in formats, else None
+    """
+    rst = _suffix_dates.get(suffix)
+    if rst is not _MISSING:
+        return rst
+    date_format = _get_date_format(suffix)
+    rst = None if date_format is None else _parse_date(suffix, date_format)
+    _suffix_dates.set(suffix, rst)
+    return rst
 
-    for index_prefix, index_config in config['indices'].items():
-        for indexname in all_indices:
-            date = pick_date_from_indexname(indexname, index_prefix)
-            if date is None:
+
+def _literal_prefix(index_prefix):
+    """
+    return the plain text every name matching index_prefix must start with
+    >>> _literal_prefix('test1-')
+    'test1-'
+    >>> _literal_prefix(r'.*-(?=\d{4}\.\d{2}$)')
+    ''
+    >>> _literal_prefix('logs?-')
+    'log'
+    >>> _literal_prefix('test-(?P<date>%Y%m%d%H)00-\d')
+    'test-'
+    """
+    if '|' in index_prefix:
+        return ''
+    prefix = []
+    for c in index_prefix:
+        if c in _REGEX_SPECIAL_CHARS:
+            if c in '*?{' and prefix:
+                prefix.pop()
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+
+class IndexPattern(object):
+    """
+    one index pattern(key of `indices` in config), with its regexes compiled once
+    """
+
+    def __init__(self, index_prefix):
+        super(IndexPattern, self).__init__()
+        self.index_prefix = index_prefix
+        self.literal_prefix = _literal_prefix(index_prefix)
+        self.date_regexes = [(re.compile(pattern_format % index_prefix), date_format)
+                             for pattern_format, date_format in _DATE_PATTERNS]
+
+        self.custom_regex = None
+        self.custom_date_format = None
+        r = re.findall(u'\(\?P<date>([^)]+)\)', index_prefix)
+        if len(r) == 1:
+            index_format = index_prefix
+            index_format = index_format.replace('%Y', r'\d{4}')
+            index_format = index_format.replace('%y', r'\d{2}')
+            index_format = index_format.replace('%m', r'\d{2}')
+            index_format = index_format.replace('%d', r'\d{2}')
+            index_format = index_format.replace('%H', r'\d{2}')
+            index_format = index_format.replace('%M', r'\d{2}')
+            index_format = index_format.replace('.', r'\.')
+            self.custom_regex = re.compile(index_format)
+            self.custom_date_format = r[0]
+
+    def pick_date(self, indexname):
+        """
+        rtype: datetime.datetime or None
+        """
+        if indexname.startswith(self.literal_prefix):
+            if self.literal_prefix == self.index_prefix:
+                # plain text prefix, the rest of the name is the date or nothing
+                date = _pick_suffix_date(indexname[len(self.literal_prefix):])
+                if date is not None:
+                    return date
+            else:
+                for regex, date_format in self.date_regexes:
+                    m = regex.match(indexname)
+                    if m and m.group(regex.groups) is not None:
+                        return _parse_date(m.group(regex.groups), date_format)
+
+        if self.custom_regex is not None and self.literal_prefix in indexname:
+            m = self.custom_regex.search(indexname)
+            if m:
+                return _parse_date(m.group('date'), self.custom_date_format)
+
+
+class IndexPatternMatcher(object):
+    """
+    all the index patterns in config, compiled once at load time.
+    patterns are dispatched by the first char of their literal prefix,
+    so an index name is only tested against the patterns that could match it
+    """
+
+    def __init__(self, index_prefixes, rules=None):
+        """
+        type rules: {index_prefix: [Rule]}, from compile_rules
+        """
+        super(IndexPatternMatcher, self).__init__()
+        self.rules = rules or {}
+        self.patterns = [IndexPattern(e) for e in index_prefixes]
+        self._dispatch = {}
+        self._always = []
+        for position, pattern in enumerate(self.patterns):
+            if pattern.custom_regex is not None or not pattern.literal_prefix:
+                # custom date patterns are searched, not anchored at the start
+                self._always.append((position, pattern))
+            else:
+                self._dispatch.setdefault(
+                    pattern.literal_prefix[0], []).append((position, pattern))
+
+    def match(self, indexname):
+        """
+        rtype: [(index_prefix, date)], in the order of patterns in config
+        """
+        candidates = self._dispatch.get(indexname[:1], []) + self._always
+        candidates.sort(key=lambda e: e[0])
+        rst = []
+        for _, pattern in candidates:
+            date = pattern.pick_date(indexname)
+            if date is not None:
+                rst.append((pattern.index_prefix, date))
+        return rst
+
+
+def compile_index_patterns(config):
+    """
+    rtype: IndexPatternMatcher
+    """
+    return IndexPatternMatcher(config['indices'].keys(), compile_rules(config))
+
+
+ACTIONS = (
+    'delete_indices',
+    'close_indices',
+    'freeze_indices',
+    'update_settings',
+    'optimize_indices',
+)
+
+
+class Plan(object):
+    """
+    what to do with which indices, built by plan_actions in one pass
+    every action maps to [(indexname, index_settings, dopey_index_settings)]
+    index_settings is None here, update_settings fetches them in bulk
+    """
+
+    def __init__(self):
+        super(Plan, self).__init__()
+        self.actions = dict((action, []) for action in ACTIONS)
+
+    def add(self, action, item):
+        self.actions.setdefault(action, []).append(item)
+
+    def get(self, action):
+        return self.actions.get(action, [])
+
+
+# single value key, range key and seconds of every unit of rules, in the order they are looked at
+_RULE_UNITS = (
+    ("day", "days", 86400),
+    ("hour", "hours", 3600),
+    ("minute", "minutes", 60),
+)
+
+
+def _age(offset):
+    """
+    type offset: datetime.timedelta
+    rtype: int, whole seconds, floored like timedelta.days
+    """
+    return offset.days * 86400 + offset.seconds
+
+
+def _compile_rule_steps(configs):
+    """
+    rtype: [(unit, from, to, final)], to is None for no upper bound.
+    a hit of any step hits the rule, a miss of a final step misses it
+    """
+    steps = []
+    for single, ranged, unit in _RULE_UNITS:
+        if single in configs:
+            steps.append((unit, int(configs[single]), int(configs[single]), False))
+        if ranged in configs:
+            value = configs[ranged]
+            if isinstance(value, basestring):
+                if '-' not in value:
+                    raise BaseException("invalid config {}".format(configs))
+                from_value, to_value = value.split('-')
+                steps.append((unit, int(from_value), int(to_value), True))
+            else:
+                steps.append((unit, int(value), None, True))
+    return steps
+
+
+def _match_rule_steps(steps, age):
+    for unit, from_value, to_value, final in steps:
+        value = age // unit
+        if from_value <= value and (to_value is None or value <= to_value):
+            return True
+        if final:
+            return False
+    return False
+
+
+class Rule(object):
+    """
+    one action of an index pattern, compiled from its configs like {"days": "3-6"}.
+    hitting the rule is a step function of the index age, kept as sorted boundaries
+    in seconds and the result below, between and above them
+    """
+
+    def __init__(self, action, configs):
+        super(Rule, self).__init__()
+        self.action = action
+        self.configs = configs
+        self.settings = configs.get('settings')
+
+        steps = _compile_rule_steps(configs)
+        boundaries = set()
+        for unit, from_value, to_value, _ in steps:
+            boundaries.add(from_value * unit)
+            if to_value is not None:
+                boundaries.add((to_value + 1) * unit)
+        self.boundaries = sorted(boundaries)
+        self.results = [_match_rule_steps(steps, self.boundaries[0] - 1 if self.boundaries else 0)]
+        self.results.extend(_match_rule_steps(steps, e) for e in self.boundaries)
+
+    def match(self, age):
+        """
+        rtype: boolean, True if an index of the age hits the rule
+        type age: int, seconds
+        >>> Rule(None, {"days": "3-6"}).match(_age(datetime.timedelta(days=4, hours=5)))
+        True
+        >>> Rule(None, {"day": 2}).match(_age(datetime.timedelta(days=3)))
+        False
+        >>> Rule(None, {"minutes": 90}).match(_age(datetime.timedelta(days=1)))
+        True
+        """
+        return self.results[bisect.bisect_right(self.boundaries, age)]
+
+    def next_change(self, age):
+        """
+        rtype: int, seconds from age until the result turns, None if never
+        >>> Rule(None, {"days": "3-6"}).next_change(_age(datetime.timedelta(days=4, hours=5)))
+        241200
+        >>> Rule(None, {"days": 10}).next_change(_age(datetime.timedelta(days=12))) is None
+        True
+        """
+        i = bisect.bisect_right(self.boundaries, age)
+        for j in range(i, len(self.boundaries)):
+            if self.results[j + 1] != self.results[i]:
+                return self.boundaries[j] - age
+        return None
+
+
+def compile_rules(config):
+    """
+    rtype: {index_prefix: [Rule]}, in the order of config
+    """
+    return dict((index_prefix, [Rule(e.keys()[0], e.values()[0]) for e in rules])
+                for index_prefix, rules in config['indices'].items())
+
+
+def get_next_evaluation(config, indexname, base_day, action_filters=None, matcher=None):
+    """
+    how long until any rule of any pattern matching indexname turns
+    rtype: datetime.timedelta, None if never
+    """
+    if matcher is None:
+        matcher = compile_index_patterns(config)
+    rst = None
+    for index_prefix, date in matcher.match(indexname):
+        offset = base_day-date
+        age = _age(offset)
+        for rule in matcher.rules[index_prefix]:
+            if action_filters is not None and rule.action not in action_filters:
+                continue
+            change = rule.next_change(age)
+            if change is None:
                 continue
+            change = datetime.timedelta(seconds=age + change) - offset
+            if rst is None or change < rst:
+                rst = change
+    return rst
 
-            for e in index_config:
-                action, configs = e.keys()[0], e.values()[0]
-                if action != to_select_action:
-                    continue
 
-                offset = base_day-date
-                if "day" in configs and offset.days == configs["day"]:
-                    index_settings = get_index_settings(config['eshost'], indexname)
-                    rst.append((indexname, index_settings, configs.get('settings')))
-                    continue
-                if "days" in configs:
-                    days = configs["days"]
-                    if isinstance(days, basestring):
-                        if '-' in days:
-                            from_day, to_day = days.split('-')
-                            if offset.days < int(from_day) or offset.days > int(to_day):
-                                continue
-                        else:
-                            raise BaseException("invalid config {}".format(configs))
-                    elif offset.days < int(days):
-                        continue
-                    index_settings = get_index_settings(config['eshost'], indexname)
-                    rst.append((indexname, index_settings, configs.get('settings')))
-                    continue
+# an index planned for the key action is not planned for the actions it supersedes
+_SUPERSEDES = {
+    'delete_indices': ('close_indices', 'freeze_indices', 'update_settings', 'optimize_indices'),
+    'close_indices': ('freeze_indices', 'update_settings', 'optimize_indices'),
+}
 
-                if "hour" in configs and offset.days*24+offset.seconds // 3600 == configs["hour"]:
-                    index_settings = get_index_settings(config['eshost'], indexname)
-                    rst.append((indexname, index_settings, configs.get('settings')))
-                    continue
-                if "hours" in configs:
-                    hour = offset.days*24 + offset.seconds//3600
-                    hours = configs["hours"]
-                    if isinstance(hours, basestring):
-                        if '-' in hours:
-                            from_hour, to_hour = hours.split('-')
-                            if hour < int(from_hour) or hour > int(to_hour):
-                                continue
-                        else:
-                            raise BaseException("invalid config {}".format(configs))
-                    elif hour < int(hours):
-                        continue
-                    index_settings = get_index_settings(config['eshost'], indexname)
-                    rst.append((indexname, index_settings, configs.get('settings')))
-                    continue
-                if "minute" in configs and offset.days*24*60+offset.seconds // 60 == configs["minute"]:
-                    index_settings = get_index_settings(config['eshost'], indexname)
-                    rst.append((indexname, index_settings, configs.get('settings')))
+
+def plan_actions(config, all_indices, base_day, action_filters=None, matcher=None):
+    """
+    walk all_indices once and match every index against the compiled rules once.
+    every index gets an action at most once, and none superseded by another of its actions.
+    an index hit by update_settings of overlapping patterns gets their settings merged,
+    for other actions the first hit rule is taken
+    type all_indices: [index record], as returned by get_indices
+    type action_filters: [action] or None for all the actions
+    type matcher: IndexPatternMatcher, compiled from config if None
+    rtype: Plan
+    """
+    plan = Plan()
+    if matcher is None:
+        matcher = compile_index_patterns(config)
+    # merged settings are shared by the indices hit by the same rules
+    merged_settings = {}
+
+    for index in all_indices:
+        indexname = index['index']
+        actions = {}
+        for index_prefix, date in matcher.match(indexname):
+            age = _age(base_day-date)
+            for rule in matcher.rules[index_prefix]:
+                if action_filters is not None and rule.action not in action_filters:
                     continue
-                if "minutes" in configs:
-                    minute = offset.days*24 + offset.seconds//60
-                    minutes = configs["minutes"]
-                    if isinstance(minutes, basestring) :
-                        if '-' in minutes:
-                            from_minute, to_minute = minutes.split('-')
-                            if minute < int(from_minute) or minute > int(to_minute):
-                                continue
-                        else:
-                            raise BaseException("invalid config {}".format(configs))
-                    elif minute < int(minutes):
-                        continue
-                    index_settings = get_index_settings(config['eshost'], indexname)
-                    rst.append((indexname, index_settings, configs.get('settings')))
+                if not rule.match(age):
                     continue
+                if rule.action not in actions:
+                    actions[rule.action] = rule.settings
+                elif rule.action == 'update_settings':
+                    key = (id(actions[rule.action]), id(rule.settings))
+                    if key not in merged_settings:
+                        merged = _flatten_index_settings(actions[rule.action])
+                        merged.update(_flatten_index_settings(rule.settings))
+                        merged_settings[key] = merged
+                    actions[rule.action] = merged_settings[key]
+
+        superseded = set(e for action in actions for e in _SUPERSEDES.get(action, ()))
+        for action in ACTIONS:
+            if action not in actions:
+                continue
+            if action in superseded:
+                logging.debug(u"{} of {} is superseded".format(action, indexname))
+                continue
+            # index settings are fetched in bulk later, only by actions need them
+            plan.add(action, (indexname, None, actions[action]))
+
+    return plan
+
+
+def _get_action_option(config, key, action, default):
+    """
+    config[key] is one value for all the actions, or {action: value, "default": value}
+    >>> _get_action_option({"concurrency": {"default": 2, "delete_indices": 4}}, "concurrency", "close_indices", 1)
+    2
+    >>> _get_action_option({"concurrency": 3}, "concurrency", "delete_indices", 1)
+    3
+    """
+    value = config.get(key, default)
+    if isinstance(value, dict):
+        return value.get(action, value.get('default', default))
+    return value
+
+
+# method, api like /_settings, protocol and query params of the actions
+_REQUEST_LINE_RESERVED_BYTES = 256
+_URL_SAFE_CHARS = "!#$%&'()*+,/:;=?@[]~"
+
+
+def _url_bytes(indexname):
+    """
+    length of indexname in the request line, after percent-encoding
+    >>> _url_bytes(u'test-2019.01.01')
+    15
+    >>> _url_bytes(u'test 2019.01.01')
+    17
+    """
+    return len(urllib.quote(indexname.encode('utf-8'), safe=_URL_SAFE_CHARS))
+
+
+def _get_max_path_bytes(config, params=None):
+    """
+    bytes left for comma joined index names in a request line of `max_url_length`,
+    which should not exceed http.max_initial_line_length(4kb by default) of elasticsearch
+    """
+    client = get_es_client(config['eshost'])
+    rst = int(config.get('max_url_length', 4096))
+    rst -= len(urlparse.urlsplit(client.eshost).path) + _REQUEST_LINE_RESERVED_BYTES
+    if params:
+        rst -= len(urllib.urlencode(params))
+    return max(1, rst)
+
 
+class Batcher(object):
+    """
+    split indices into batches of at most `batch` indices, `batch_max_shards` shards
+    and `batch_max_bytes` bytes of store size, whose comma joined names fit in
+    max_path_bytes of the request line. with `batch_target_latency`, the count
+    limit is halved after a batch slower than it and doubled back after a fast one
+    """
+
+    def __init__(self, batch, index_stats=None, max_shards=None, max_bytes=None,
+                 target_latency=None, max_path_bytes=None):
+        """
+        type index_stats: {indexname: (shards, store_bytes)}
+        """
+        super(Batcher, self).__init__()
+        self.max_size = max(1, int(batch))
+        self.size = self.max_size
+        self.index_stats = index_stats or {}
+        self.max_shards = max_shards
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.max_path_bytes = max_path_bytes
+
+    def split(self, indices):
+        """
+        generate batches lazily, so feedback of finished batches shapes the next ones
+        >>> list(Batcher(3, {"a": (10, 1), "b": (10, 1)}, max_shards=15).split(["a", "b", "c", "d", "e"]))
+        [['a'], ['b', 'c', 'd'], ['e']]
+        >>> list(Batcher(10, max_path_bytes=10).split(["aaaa", "bbbb", "cccc", "dddddddddddd"]))
+        [['aaaa', 'bbbb'], ['cccc'], ['dddddddddddd']]
+        """
+        batch, shards, size, path_bytes = [], 0, 0, 0
+        for indexname in indices:
+            index_shards, index_bytes = self.index_stats.get(indexname, (0, 0))
+            # one more byte for the comma
+            name_bytes = _url_bytes(indexname) + 1
+            if batch and (
+                    len(batch) >= self.size or
+                    self.max_shards and shards + index_shards > self.max_shards or
+                    self.max_bytes and size + index_bytes > self.max_bytes or
+                    self.max_path_bytes and path_bytes + name_bytes - 1 > self.max_path_bytes):
+                yield batch
+                batch, shards, size, path_bytes = [], 0, 0, 0
+            batch.append(indexname)
+            shards += index_shards
+            size += index_bytes
+            path_bytes += name_bytes
+        if batch:
+            yield batch
+
+    def feedback(self, seconds):
+        if not self.target_latency:
+            return
+        if seconds > self.target_latency:
+            self.size = max(1, self.size // 2)
+        elif seconds < self.target_latency / 2.0:
+            self.size = min(self.max_size, self.size * 2)
+
+
+def get_batcher(config, action, indices, inventory=None):
+    """
+    type inventory: {indexname: index record}, index stats are fetched if it is None and needed
+    rtype: Batcher for indices of action
+    """
+    max_shards = _get_action_option(config, 'batch_max_shards', action, None)
+    max_bytes = _get_action_option(config, 'batch_max_bytes', action, None)
+    target_latency = _get_action_option(config, 'batch_target_latency', action, None)
+
+    index_stats = {}
+    if inventory is not None:
+        for indexname in indices:
+            index = inventory.get(indexname)
+            if index is not None:
+                index_stats[indexname] = (
+                    (index['pri'] or 0) * (1 + (index['rep'] or 0)),
+                    index['store_size'] or 0)
+    elif max_shards or max_bytes:
+        for row in _cat(config, 'indices', indices, 'index,pri,rep,store.size', {"bytes": "b"}):
+            index_stats[row['index']] = (
+                int(row['pri'] or 0) * (1 + int(row['rep'] or 0)),
+                int(row.get('store.size') or 0))
+
+    return Batcher(
+        _get_action_option(config, 'batch', action, 50),
+        index_stats,
+        max_shards=max_shards and int(max_shards),
+        max_bytes=max_bytes and int(max_bytes),
+        target_latency=target_latency and float(target_latency),
+        max_path_bytes=_get_max_path_bytes(config))
+
+
+class MasterThrottle(object):
+    """
+    hold batches back while the master is under pressure: too many pending cluster tasks,
+    or too many shards relocating or initializing. limits not set are not checked.
+    above half of any limit batches are sent one at a time
+    """
+
+    def __init__(self, eshost, max_pending_tasks=None, max_relocating_shards=None,
+                 max_initializing_shards=None, check_interval=5, max_wait=600):
+        super(MasterThrottle, self).__init__()
+        self.eshost = eshost
+        self.max_pending_tasks = max_pending_tasks
+        self.max_relocating_shards = max_relocating_shards
+        self.max_initializing_shards = max_initializing_shards
+        self.check_interval = check_interval
+        self.max_wait = max_wait
+
+    def _get(self, path, params):
+        client = get_es_client(self.eshost)
+        try:
+            r = client.get(path, params=params)
+        except Exception as e:
+            logging.warn(u"failed to get {}. {}".format(path, e))
+            return None
+        if not r.ok:
+            logging.warn(u"failed to get {}. {}".format(path, r.text))
+            return None
+        return r.json()
+
+    def pressure(self):
+        """
+        rtype: (float, str), the highest ratio of a value to its limit and what it is.
+        0 if nothing could be checked
+        """
+        values = []
+        if self.max_pending_tasks is not None:
+            r = self._get('_cluster/pending_tasks', {'filter_path': 'tasks.insert_order'})
+            if r is not None:
+                values.append(('pending_tasks', len(r.get('tasks', [])), self.max_pending_tasks))
+        if self.max_relocating_shards is not None or self.max_initializing_shards is not None:
+            r = self._get('_cluster/health',
+                          {'filter_path': 'relocating_shards,initializing_shards'})
+            if r is not None:
+                for key, limit in (('relocating_shards', self.max_relocating_shards),
+                                   ('initializing_shards', self.max_initializing_shards)):
+                    if limit is not None:
+                        values.append((key, r.get(key, 0), limit))
+        rst = (0.0, None)
+        for key, value, limit in values:
+            ratio = float(value) / limit if limit > 0 else float(value > 0) * 2
+            if ratio > rst[0]:
+                rst = (ratio, u"{} {}".format(value, key))
+        return rst
+
+    def wait(self, concurrency):
+        """
+        sleep while any limit is exceeded, at most `max_wait` seconds
+        rtype: int, batches allowed in flight now
+        """
+        start = time.time()
+        ratio, reason = self.pressure()
+        if ratio > 1:
+            logging.info(u"master is under pressure, {}. batches are paused".format(reason))
+            while ratio > 1 and time.time() - start < self.max_wait:
+                time.sleep(self.check_interval)
+                ratio, reason = self.pressure()
+            seconds = time.time() - start
+            _record('throttle_waits', 1)
+            _record('throttle_seconds', seconds)
+            if ratio > 1:
+                logging.warn(u"master is still under pressure after {:.0f}s, {}. "
+                             u"batches go on".format(seconds, reason))
+            else:
+                logging.info(u"batches resume after {:.0f}s".format(seconds))
+        if ratio > 0.5:
+            return 1
+        return concurrency
+
+
+def get_throttle(config):
+    """
+    `throttle` in config
+    rtype: MasterThrottle, None if not configured
+    """
+    options = config.get('throttle')
+    if not options:
+        return None
+
+    def limit(key):
+        value = options.get(key)
+        return None if value is None else int(value)
+    return MasterThrottle(
+        config['eshost'],
+        max_pending_tasks=limit('max_pending_tasks'),
+        max_relocating_shards=limit('max_relocating_shards'),
+        max_initializing_shards=limit('max_initializing_shards'),
+        check_interval=float(options.get('check_interval', 5)),
+        max_wait=float(options.get('max_wait', 600)))
+
+
+def _get_done(done):
+    # Queue.get without timeout could not be interrupted by ctrl-c
+    while True:
+        try:
+            return done.get(timeout=1)
+        except Queue.Empty:
+            continue
+
+
+def _call_batch(func, batch, done=None):
+    start = time.time()
+    try:
+        r = func(batch)
+    except Exception as e:
+        logging.error(u"batch {} failed. {}".format(batch, e))
+        r = False
+    rst = (batch, r, time.time() - start)
+    if done is not None:
+        done.put(rst)
     return rst
 
 
-def get_to_delete_indices(config, all_indices, base_day):
-    return get_to_process_indices(
-        'delete_indices', config, all_indices, base_day)
+def run_batches(config, action, batches, func, batcher=None, callback=None):
+    """
+    call func on every batch, with at most `concurrency` batches in flight,
+    fewer or none while the master is under pressure if `throttle` is configured.
+    it returns after all the batches are done, so actions still run one after another
+    type batches: iterable, consumed lazily
+    type batcher: Batcher generating the batches, it is told the latency of every finished batch
+    type callback: called with (batch, result of func) as soon as every batch is done
+    rtype: [(batch, result of func)]
+    """
+    concurrency = int(_get_action_option(config, 'concurrency', action, 1))
+    results = []
+
+    def collect(rst):
+        batch, r, seconds = rst
+        _record('latencies', seconds)
+        if batcher is not None:
+            batcher.feedback(seconds)
+        if callback is not None:
+            callback(batch, r)
+        results.append((batch, r))
+
+    throttle = get_throttle(config)
+
+    if concurrency <= 1:
+        for batch in batches:
+            if throttle is not None:
+                throttle.wait(1)
+            collect(_call_batch(func, batch))
+        return results
+
+    done = Queue.Queue()
+    pool = ThreadPool(concurrency)
+    try:
+        inflight = 0
+        for batch in batches:
+            limit = concurrency
+            if throttle is not None:
+                limit = throttle.wait(concurrency)
+            while inflight >= limit:
+                collect(_get_done(done))
+                inflight -= 1
+            pool.apply_async(_call_batch, (func, batch, done))
+            inflight += 1
+        while inflight:
+            collect(_get_done(done))
+            inflight -= 1
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+# method, path of comma joined indices, and past tense for logs of every action
+_ACTION_REQUESTS = {
+    'delete_indices': ('DELETE', u"{}", u"deleted"),
+    'close_indices': ('POST', u"{}/_close", u"closed"),
+    'freeze_indices': ('POST', u"{}/_freeze", u"freezed"),
+    'update_settings': ('PUT', u"{}/_settings", u"updated"),
+    'optimize_indices': ('POST', u"{}/_forcemerge", u"forcemerged"),
+}
+
+
+def _get_unapplied_indices(config, action, indices, settings=None):
+    """
+    indices of a not acknowledged request still not in the state wanted by action.
+    missing indices are ignored as ignore_unavailable does
+    :type settings: settings delta of update_settings
+    :rtype: [indexname]
+    """
+    if action == 'delete_indices':
+        existing = set(row['index'] for row in _cat(
+            config, 'indices', indices, 'index', {"ignore_unavailable": "true"}))
+        return [e for e in indices if e in existing]
+    if action == 'close_indices':
+        opened = set(row['index'] for row in _cat(
+            config, 'indices', indices, 'index,status', {"ignore_unavailable": "true"})
+            if row.get('status') != 'close')
+        return [e for e in indices if e in opened]
+
+    if action == 'freeze_indices':
+        wanted = {"index.frozen": "true"}
+    else:
+        wanted = settings
+    # no filter_path, indices lacking the keys would be left out like missing ones
+    all_settings = get_indices_settings(config, indices)
+    return [e for e in indices
+            if e in all_settings and _diff_index_settings(wanted, _flatten_index_settings(all_settings[e]))]
+
+
+def _read_failed_indices(action, to_process_indices, body):
+    """
+    read which indices a 2xx response body tells the action did not apply to.
+    close tells the result of every index, sync forcemerge lists its shard failures
+    :type body: decoded json of the response
+    :rtype: [indexname], None if the response is not acknowledged and tells no more
+    >>> _read_failed_indices('close_indices', ['a', 'b', 'c'], {"acknowledged": False,
+    ...     "indices": {"a": {"closed": True}, "b": {"closed": False, "failures": []}}})
+    ['b']
+    >>> _read_failed_indices('optimize_indices', ['a', 'b'], {"_shards": {"failed": 1,
+    ...     "failures": [{"index": "b", "shard": 0}]}})
+    ['b']
+    >>> _read_failed_indices('delete_indices', ['a', 'b'], {"acknowledged": True})
+    []
+    >>> _read_failed_indices('delete_indices', ['a', 'b'], {"acknowledged": False}) is None
+    True
+    """
+    if action == 'optimize_indices':
+        failures = (body.get('_shards') or {}).get('failures') or []
+        failed = set(e.get('index') for e in failures)
+        return [e for e in to_process_indices if e in failed]
 
+    if action == 'close_indices' and body.get('indices'):
+        # indices left out of the response do not exist and are ignored
+        return [e for e in to_process_indices
+                if e in body['indices'] and not body['indices'][e].get('closed')]
 
-def get_to_close_indices(config, all_indices, base_day):
-    return get_to_process_indices(
-        'close_indices', config, all_indices, base_day)
+    if body.get('acknowledged', True):
+        return []
+    return None
 
 
-def get_to_freeze_indices(config, all_indices, base_day):
-    return get_to_process_indices(
-        'freeze_indices', config, all_indices, base_day)
+def _get_failed_indices(config, action, to_process_indices, settings, r):
+    """
+    read which indices a 2xx response did not apply to.
+    an unacknowledged response telling no more is checked against the cluster state
+    :type r: response
+    :rtype: [indexname]
+    """
+    try:
+        body = r.json()
+    except ValueError:
+        body = {}
 
+    failed = _read_failed_indices(action, to_process_indices, body)
+    if failed is not None:
+        return failed
+    logging.warn(u"{} of {} is not acknowledged, check the indices".format(
+        action, ','.join(to_process_indices)))
+    return _get_unapplied_indices(config, action, to_process_indices, settings)
 
-def get_to_update_indices(config, all_indices, base_day):
-    return get_to_process_indices(
-        'update_settings', config, all_indices, base_day)
 
+# a wildcard expression ends right after one of them, like test1-2024.03.*
+_WILDCARD_SEPARATORS = frozenset('.-_')
+# and holds a year at least, so it stands for a date range but never a whole family like test1-*
+_WILDCARD_YEAR = re.compile(r'\d{4}')
+
+
+class WildcardCompactor(object):
+    """
+    replace index names of a batch with name prefix wildcards, when a wildcard
+    hits exactly the same indices in the inventory as the names it replaces
+    and no alias, which elasticsearch would expand it to as well
+    """
 
-def get_to_optimize_indices(config, all_indices, base_day):
-    return get_to_process_indices(
-        'optimize_indices', config, all_indices, base_day)
+    def __init__(self, all_indices, aliases=()):
+        """
+        type all_indices: [indexname], all the indices existing, hidden and closed ones included
+        type aliases: [alias name]
+        """
+        super(WildcardCompactor, self).__init__()
+        self.all_indices = sorted(all_indices)
+        self.aliases = sorted(aliases)
+
+    @staticmethod
+    def _count(sorted_names, prefix):
+        return (bisect.bisect_left(sorted_names, prefix + u'\uffff') -
+                bisect.bisect_left(sorted_names, prefix))
+
+    def compact(self, indices):
+        """
+        the shortest wildcards first, names left as they are if no wildcard fits
+        type indices: [indexname]
+        rtype: [wildcard expression or indexname]
+        >>> WildcardCompactor(['a-2024.03.01', 'a-2024.03.02', 'a-2024.04.01', 'b-1']).compact(
+        ...     ['a-2024.03.02', 'a-2024.03.01', 'b-1'])
+        [u'a-2024.03.*', 'b-1']
+        >>> WildcardCompactor(['a-2024.03.01', 'a-2024.03.02'], aliases=['a-2024.03.x']).compact(
+        ...     ['a-2024.03.01', 'a-2024.03.02'])
+        ['a-2024.03.01', 'a-2024.03.02']
+        """
+        indices = sorted(set(indices))
+        rst = []
+        i = 0
+        while i < len(indices):
+            indexname = indices[i]
+            step = 1
+            token = indexname
+            # hidden indices are not hit by wildcards
+            if not indexname.startswith('.'):
+                for end in range(1, len(indexname)):
+                    if indexname[end - 1] not in _WILDCARD_SEPARATORS:
+                        continue
+                    prefix = indexname[:end]
+                    if not _WILDCARD_YEAR.search(prefix):
+                        continue
+                    count = self._count(indices, prefix)
+                    if (count > 1 and count == self._count(self.all_indices, prefix) and
+                            not self._count(self.aliases, prefix)):
+                        token = u"{}*".format(prefix)
+                        step = count
+                        break
+            rst.append(token)
+            i += step
+        return rst
 
 
-def delete_indices(config, indices):
+def _send_batch(config, action, to_process_indices, settings=None, retry=None, expressions=None):
     """
-    :type indices: list of (indexname,index_settings, dopey_index_settings)
-    :rtype: None
+    one request of action for to_process_indices under the retry policy.
+    a batch refused with 400 is split in halves to isolate the bad indices, every half
+    taking from the retry budget,
+    and only the indices the response tells failed are sent again
+    :type settings: settings delta of update_settings, forcemerge params of optimize_indices, else None
+    :type retry: attempts left, `retry` in config if None
+    :type expressions: [wildcard expression or indexname] standing for to_process_indices in the first request
+    :rtype: [([indexname], ok)]
+    """
+    if retry is None:
+        retry = int(_get_action_option(config, 'retry', action, 1 if action == 'optimize_indices' else 3))
+    client = get_es_client(config['eshost'])
+    method, path_format, done = _ACTION_REQUESTS[action]
+    to_process_indices_joined = ','.join(to_process_indices)
+    path = path_format.format(','.join(expressions or to_process_indices))
+
+    kwargs = {"params": {"master_timeout": "10m", "ignore_unavailable": 'true'}}
+    if action == 'update_settings':
+        kwargs["data"] = json.dumps(settings)
+    elif action == 'optimize_indices':
+        # forcemerge may take hours, never time out
+        kwargs = {"params": settings, "timeout": None}
+    if expressions and any('*' in e for e in expressions):
+        # hit closed and hidden indices as the inventory has them
+        kwargs["params"] = dict(kwargs["params"], expand_wildcards="all")
+    logging.info(u"{} {}".format(method, client.url(path)))
+
+    r = request_with_retry(client, method, path, retry, **kwargs)
+    if r is not None and r.ok:
+        failed = _get_failed_indices(config, action, to_process_indices, settings, r)
+        if not failed:
+            logging.info(u"%s %s" % (to_process_indices_joined, done))
+            return [(to_process_indices, True)]
+
+        logging.warn(u"%s not %s. %s" % (','.join(failed), done, r.text))
+        failed_set = set(failed)
+        succeeded = [e for e in to_process_indices if e not in failed_set]
+        rst = [(succeeded, True)] if succeeded else []
+        if retry > 1 and _retry_policy.acquire():
+            _record('retries', 1)
+            _retry_policy.wait(1)
+            return rst + _send_batch(config, action, failed, settings, retry - 1)
+        return rst + [(failed, False)]
+
+    logging.warn(
+        u"%s %s failed. %s" %
+        (to_process_indices_joined, done, r.text if r is not None else u"no response"))
+    # other errors like 401, 403 or cluster blocks would be hit by every half the same
+    if r is not None and r.status_code == 400 and len(to_process_indices) > 1:
+        half = len(to_process_indices) // 2
+        rst = []
+        for part in (to_process_indices[:half], to_process_indices[half:]):
+            if _retry_policy.acquire():
+                _record('retries', 1)
+                rst.extend(_send_batch(config, action, part, settings))
+            else:
+                rst.append((part, False))
+        return rst
+    return [(to_process_indices, False)]
+
+
+def _flatten_results(results):
     """
+    :type results: [(batch, [([indexname], ok)] or False)], False if the sender raised
+    :rtype: [([indexname], ok)]
+    """
+    rst = []
+    for batch, r in results:
+        if r is False:
+            rst.append((batch[0], False))
+        else:
+            rst.extend(r)
+    return rst
+
+
+def prepare_action(config, action, indices, inventory=None):
+    """
+    drop indices already in the wanted state and group the rest by the settings of their requests.
+    it only reads from elasticsearch
+    :type indices: [(indexname,index_settings, dopey_index_settings)]
+    :type inventory: {indexname: index record}
+    :rtype: [(settings, [indexname])], settings is the settings delta of update_settings,
+            forcemerge params of optimize_indices, else None
+    """
+    if not indices:
+        return []
+
+    if action == 'close_indices' and inventory is not None:
+        indices = find_need_to_close_indices(indices, inventory)
+    elif action == 'freeze_indices' and inventory is not None:
+        indices = find_need_to_freeze_indices(indices, inventory)
+
+    if action == 'update_settings':
+        keys = set()
+        for _, _, dopey_index_settings in indices:
+            keys.update(_flatten_index_settings(dopey_index_settings).keys())
+        with phase('settings_fetch'):
+            all_settings = get_indices_settings(config, [e[0] for e in indices], keys)
+        indices = [(indexname, all_settings.get(indexname, {}), dopey_index_settings)
+                   for indexname, _, dopey_index_settings in indices]
+
+        need_to_update_indices = find_need_to_update_indices(indices)
+        logging.debug(u"need_to_update_indices: %s", need_to_update_indices)
+
+        # grouped by the delta, so every request carries only the keys its indices need
+        to_update_indices = arrange_indices_by_settings(need_to_update_indices)
+        logging.debug(u"to_update_indices: %s", to_update_indices)
+        return to_update_indices
+
+    if action == 'optimize_indices':
+        indices = find_need_to_optimize_indices(config, indices, inventory)
+        # default params first, so the same forcemerge params fall into one group
+        to_optimize_indices = []
+        for index, index_settings, dopey_index_settings in indices:
+            dopey_index_settings = dict(dopey_index_settings or {})
+            dopey_index_settings.setdefault("max_num_segments", 1)
+            to_optimize_indices.append((index, index_settings, dopey_index_settings))
+        return arrange_indices_by_settings(to_optimize_indices)
+
     if not indices:
-        return
+        return []
+    return [(None, [e[0] for e in indices])]
+
+
+def _forcemerge_async(config, action):
+    return action == 'optimize_indices' and (config.get('forcemerge') or {}).get('async')
+
+
+def _wildcard_batches(config, action):
+    """
+    `wildcard_batches` in config. a plain true leaves delete_indices out: elasticsearch 8
+    refuses wildcards in deletes by default, every batch would fail and be split
+    >>> _wildcard_batches({"wildcard_batches": True}, "close_indices")
+    True
+    >>> _wildcard_batches({"wildcard_batches": True}, "delete_indices")
+    False
+    >>> _wildcard_batches({"wildcard_batches": {"default": True, "delete_indices": True}}, "delete_indices")
+    True
+    """
+    value = config.get('wildcard_batches', False)
+    if action == 'delete_indices' and not (isinstance(value, dict) and 'delete_indices' in value):
+        return False
+    return bool(_get_action_option(config, 'wildcard_batches', action, False))
+
+
+def _get_alias_names(eshost):
+    """
+    rtype: [alias name], None if they could not be got
+    """
+    client = get_es_client(eshost)
+    try:
+        r = client.get("_cat/aliases", params={"format": "json", "h": "alias"})
+        if not r.ok:
+            raise Exception(r.text)
+        return [row["alias"] for row in r.json()]
+    except Exception as e:
+        logging.warn(u"could not get aliases, batches are sent without wildcards. {}".format(e))
+        return None
+
+
+def execute_action(config, action, groups, inventory=None, stats=None, journal=None, tasks=None):
+    """
+    send the groups from prepare_action in batches. batches of all the groups share
+    one worker pool and one batcher
+    :type groups: [(settings, [indexname])]
+    :type inventory: {indexname: index record}
+    :type stats: list, [(indexname, seconds, segments_before, segments_after)] are appended to it by async forcemerge
+    :type journal: Journal, every batch done is written to it
+    :type tasks: {indexname: task}, forcemerges submitted by a killed run, polled instead of submitted again
+    :rtype: [([indexname], ok)]
+    """
+    if not groups:
+        return []
+
+    if _forcemerge_async(config, action):
+        results, merge_stats = _optimize_indices_async(
+            config, [(indexname, settings)
+                     for settings, same_settings_indices in groups
+                     for indexname in same_settings_indices],
+            inventory, journal, tasks)
+        if stats is not None:
+            stats.extend(merge_stats)
+        return results
+
+    batcher = get_batcher(
+        config, action, [e for _, same_settings_indices in groups for e in same_settings_indices],
+        inventory)
+    batches = ((batch_indices, settings)
+               for settings, same_settings_indices in groups
+               for batch_indices in batcher.split(same_settings_indices))
+    compactor = None
+    if inventory is not None and _wildcard_batches(config, action):
+        aliases = _get_alias_names(config['eshost'])
+        if aliases is not None:
+            compactor = WildcardCompactor(inventory.keys(), aliases)
+    results = run_batches(
+        config, action, batches,
+        lambda e: _send_batch(
+            config, action, e[0], e[1],
+            expressions=compactor and compactor.compact(e[0])),
+        batcher,
+        journal and (lambda batch, r: journal.done(action, _flatten_results([(batch, r)]))))
+    return _flatten_results(results)
+
+
+def plan_batches(config, action, groups, inventory=None):
+    """
+    the batches execute_action would send, without latency feedback
+    :type groups: [(settings, [indexname])]
+    :type inventory: {indexname: index record}
+    :rtype: [{"action", "indices", "settings", "shards"}], shards is estimated from inventory
+    """
+    if _forcemerge_async(config, action):
+        batches = [([indexname], settings)
+                   for settings, same_settings_indices in groups
+                   for indexname in same_settings_indices]
+    else:
+        batcher = get_batcher(
+            config, action, [e for _, same_settings_indices in groups for e in same_settings_indices],
+            inventory)
+        batches = [(batch_indices, settings)
+                   for settings, same_settings_indices in groups
+                   for batch_indices in batcher.split(same_settings_indices)]
+
+    rst = []
+    for batch_indices, settings in batches:
+        shards = None
+        if inventory is not None:
+            shards = sum((inventory[e]['pri'] or 0) * (1 + (inventory[e]['rep'] or 0))
+                         for e in batch_indices if e in inventory)
+        rst.append({
+            "action": action,
+            "indices": batch_indices,
+            "settings": settings,
+            "shards": shards,
+        })
+    return rst
 
-    retry = config.get('retry', 3)
-    batch = config.get('batch', 50)
-    indices = [e[0] for e in indices]
 
-    logging.debug(u"try to delete %s" % ",".join(indices))
-    while indices:
-        to_delete_indices = indices[:batch]
-        to_delete_indices_joined = ','.join(to_delete_indices)
-        url = u"{}/{}".format(
-            config['eshost'], to_delete_indices_joined)
-        logging.info(u"delete: {}".format(url))
+def execute_batches(config, action, batches, stats=None):
+    """
+    send batches of a saved plan as they are
+    :type batches: [([indexname], settings)]
+    :type stats: list, [(indexname, seconds, segments_before, segments_after)] are appended to it by async forcemerge
+    :rtype: [([indexname], ok)]
+    """
+    if _forcemerge_async(config, action):
+        results, merge_stats = _optimize_indices_async(
+            config, [(indexname, settings)
+                     for batch_indices, settings in batches
+                     for indexname in batch_indices])
+        if stats is not None:
+            stats.extend(merge_stats)
+        return results
+
+    results = run_batches(
+        config, action, batches,
+        lambda e: _send_batch(config, action, e[0], e[1]))
+    return _flatten_results(results)
+
+
+class Journal(object):
+    """
+    append-only json lines of runs: the groups every action prepared, the batches done
+    and the forcemerge tasks submitted, so a run killed halfway could be resumed.
+    every run appends to the file, the last start event begins the run to resume
+    """
 
-        for _ in range(retry):
+    def __init__(self, path):
+        super(Journal, self).__init__()
+        self.path = path
+        self._f = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        self._f = open(self.path, 'a')
+        return self
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def write(self, event, **kwargs):
+        kwargs.update(event=event, time=time.time())
+        line = json.dumps(kwargs) + '\n'
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def start(self, base_day, action_filters):
+        self.write('start', base_day=base_day.strftime(r"%Y-%m-%d %H:%M:%S"),
+                   action_filters=list(action_filters))
+
+    def prepared(self, action, groups):
+        self.write('prepared', action=action, groups=groups)
+
+    def done(self, action, results):
+        for indices, ok in results:
+            self.write('done', action=action, indices=indices, ok=ok)
+
+    def submitted(self, indexname, task):
+        self.write('submitted', index=indexname, task=task)
+
+    def finish(self):
+        self.write('finish')
+
+    @staticmethod
+    def load(path):
+        """
+        rtype: the state of the last run in the journal file, see read
+        """
+        try:
+            f = open(path)
+        except IOError:
+            return None
+        with f:
+            return Journal.read(f)
+
+    @staticmethod
+    def read(lines):
+        """
+        rtype: None if there is no run to resume, else
+            {"base_day", "action_filters", "groups": {action: groups}, "done": {action: set(indexname)},
+            "tasks": {indexname: task}}, only indices done ok are in "done"
+        >>> lines = [
+        ...     '{"event": "start", "base_day": "2024-05-10 00:00:00", "action_filters": ["delete_indices"]}',
+        ...     '{"event": "prepared", "action": "delete_indices", "groups": [[null, ["a-2024.05.01", "a-2024.05.02"]]]}',
+        ...     '{"event": "done", "action": "delete_indices", "indices": ["a-2024.05.01"], "ok": true}',
+        ...     '{"event": "done", "action": "delete_indices", "indices": ["a-2024.05.0']
+        >>> state = Journal.read(lines)
+        >>> state["base_day"], state["action_filters"]
+        (datetime.datetime(2024, 5, 10, 0, 0), [u'delete_indices'])
+        >>> sorted(state["done"]["delete_indices"])
+        [u'a-2024.05.01']
+        >>> Journal.read(lines + ['{"event": "finish"}']) is None
+        True
+        """
+        state = None
+        for line in lines:
             try:
-                r = requests.delete(
-                    url, timeout=300, params={
-                        "master_timeout": "10m", "ignore_unavailable": 'true'}, headers={
-                        "content-type": "application/json"})
-                if r.ok:
-                    logging.info(u"%s deleted" % to_delete_indices_joined)
-                    break
-                else:
-                    logging.warn(
-                        u"%s deleted failed. %s" %
-                        (to_delete_indices_joined, r.text))
-            except BaseException as e:
-                logging.info(e)
-        indices = indices[batch:]
-
-
-def close_indices(config, indices):
+                e = json.loads(line)
+            except ValueError:
+                # the last line of a killed run may be cut
+                logging.warn(u"skip broken journal line: {}".format(line.strip()))
+                continue
+            if e['event'] == 'start':
+                state = {
+                    "base_day": datetime.datetime.strptime(e['base_day'], r"%Y-%m-%d %H:%M:%S"),
+                    "action_filters": e['action_filters'],
+                    "groups": {},
+                    "done": collections.defaultdict(set),
+                    "tasks": {},
+                }
+            elif state is None:
+                continue
+            elif e['event'] == 'prepared':
+                state['groups'][e['action']] = [(settings, indices) for settings, indices in e['groups']]
+            elif e['event'] == 'done' and e['ok']:
+                state['done'][e['action']].update(e['indices'])
+            elif e['event'] == 'submitted':
+                state['tasks'][e['index']] = e['task']
+            elif e['event'] == 'finish':
+                state = None
+        return state
+
+    @staticmethod
+    def unstarted(state, plan):
+        """
+        the actions of plan not prepared in state. indices in the prepared groups of an action
+        superseding another are left out of the other
+        :type plan: Plan, planned with all the action filters of the run
+        rtype: Plan
+        >>> state = {"groups": {"delete_indices": [(None, ["a-2024.05.01"])]}}
+        >>> plan = Plan()
+        >>> plan.add('delete_indices', ('a-2024.05.01', None, {}))
+        >>> plan.add('close_indices', ('a-2024.05.01', None, {}))
+        >>> plan.add('close_indices', ('a-2024.05.02', None, {}))
+        >>> unstarted = Journal.unstarted(state, plan)
+        >>> unstarted.get('delete_indices'), unstarted.get('close_indices')
+        ([], [('a-2024.05.02', None, {})])
+        """
+        rst = Plan()
+        for action in ACTIONS:
+            if action in state['groups']:
+                continue
+            superseded = set(
+                indexname
+                for other, groups in state['groups'].items() if action in _SUPERSEDES.get(other, ())
+                for _, indices in groups for indexname in indices)
+            for e in plan.get(action):
+                if e[0] in superseded:
+                    logging.debug(u"{} of {} is superseded by the resumed run".format(action, e[0]))
+                    continue
+                rst.add(action, e)
+        return rst
+
+    @staticmethod
+    def remaining(state, action):
+        """
+        rtype: groups of action prepared in state, less the indices done, None if action was not prepared
+        >>> state = {"groups": {"delete_indices": [(None, ["a-2024.05.01", "a-2024.05.02"])]},
+        ...          "done": {"delete_indices": set(["a-2024.05.01"])}}
+        >>> Journal.remaining(state, 'delete_indices')
+        [(None, ['a-2024.05.02'])]
+        >>> Journal.remaining(state, 'close_indices') is None
+        True
+        """
+        if action not in state['groups']:
+            return None
+        done = state['done'][action]
+        groups = []
+        for settings, indices in state['groups'][action]:
+            indices = [e for e in indices if e not in done]
+            if indices:
+                groups.append((settings, indices))
+        return groups
+
+
+def delete_indices(config, indices, inventory=None):
     """
     :type indices: list of (indexname,index_settings, dopey_index_settings)
-    :rtype: None
+    :type inventory: {indexname: index record}
+    :rtype: [([indexname], ok)]
     """
-    if not indices:
-        return
+    return execute_action(
+        config, 'delete_indices',
+        prepare_action(config, 'delete_indices', indices, inventory), inventory)
 
-    retry = config.get('retry', 3)
-    batch = config.get('batch', 50)
-    indices = [e[0] for e in indices]
 
-    while indices:
-        to_close_indices = indices[:batch]
-        to_close_indices_joined = ','.join(to_close_indices)
-        logging.debug(u"try to close %s" % to_close_indices_joined)
+def close_indices(config, indices, inventory=None):
+    """
+    :type indices: list of (indexname,index_settings, dopey_index_settings)
+    :type inventory: {indexname: index record}
+    :rtype: [([indexname], ok)]
+    """
+    return execute_action(
+        config, 'close_indices',
+        prepare_action(config, 'close_indices', indices, inventory), inventory)
 
-        url = u"{}/{}/_close".format(
-            config['eshost'], to_close_indices_joined)
-        logging.info(u"close: {}".format(url))
 
-        for _ in range(retry):
-            try:
-                r = requests.post(
-                    url,
-                    timeout=300,
-                    params={
-                        "master_timeout": "10m",
-                        "ignore_unavailable": 'true'}, headers={"content-type": "application/json"})
-
-                if r.ok:
-                    logging.info(u"%s closed" % to_close_indices_joined)
-                    break
-                else:
-                    logging.warn(
-                        u"%s closed failed. %s" %
-                        (to_close_indices_joined, r.text))
-            except BaseException as e:
-                logging.info(e)
-        indices = indices[batch:]
-
-
-def freeze_indices(config, indices):
+def freeze_indices(config, indices, inventory=None):
     """
     :type indices: list of (indexname,index_settings, dopey_index_settings)
-    :rtype: None
+    :type inventory: {indexname: index record}
+    :rtype: [([indexname], ok)]
     """
-    if not indices:
-        return
+    return execute_action(
+        config, 'freeze_indices',
+        prepare_action(config, 'freeze_indices', indices, inventory), inventory)
 
-    retry = config.get('retry', 3)
-    batch = config.get('batch', 50)
-    indices = [e[0] for e in indices]
 
-    while indices:
-        to_freeze_indices = indices[:batch]
-        to_freeze_indices_joined = ','.join(to_freeze_indices)
-        logging.debug(u"try to freeze %s" % to_freeze_indices_joined)
+def find_need_to_close_indices(indices, inventory):
+    """
+    :type indices: [(indexname,index_settings, dopey_index_settings)]
+    :type inventory: {indexname: index record}
+    :rtype : [(indexname,index_settings, dopey_index_settings)]
+    """
+    rst = []
+    for e in indices:
+        index = inventory.get(e[0])
+        if index is not None and index['status'] == 'close':
+            logging.info(u"%s is already closed, skip" % e[0])
+            continue
+        rst.append(e)
+    return rst
 
-        url = u"{}/{}/_freeze".format(
-            config['eshost'], to_freeze_indices_joined)
-        logging.info(u"freeze: {}".format(url))
 
-        for _ in range(retry):
-            try:
-                r = requests.post(
-                    url,
-                    timeout=300,
-                    params={
-                        "master_timeout": "10m",
-                        "ignore_unavailable": 'true'}, headers={"content-type": "application/json"})
-
-                if r.ok:
-                    logging.info(u"%s freezed" % to_freeze_indices_joined)
-                    break
-                else:
-                    logging.warn(
-                        u"%s freezed failed. %s" %
-                        (to_freeze_indices_joined, r.text))
-            except BaseException as e:
-                logging.info(e)
-        indices = indices[batch:]
+def find_need_to_freeze_indices(indices, inventory):
+    """
+    :type indices: [(indexname,index_settings, dopey_index_settings)]
+    :type inventory: {indexname: index record}
+    :rtype : [(indexname,index_settings, dopey_index_settings)]
+    """
+    rst = []
+    for e in indices:
+        index = inventory.get(e[0])
+        if index is not None and index['frozen']:
+            logging.info(u"%s is already frozen, skip" % e[0])
+            continue
+        rst.append(e)
+    return rst
 
 
-def find_need_to_update_indices(indices):
+def find_need_to_optimize_indices(config, indices, inventory=None):
     """
+    skip closed indices and those whose every shard copy has no more than
+    max_num_segments segments, counted from _cat/segments.
+    indices without segment rows are kept
     :type indices: [(indexname,index_settings, dopey_index_settings)]
+    :type inventory: {indexname: index record}
     :rtype : [(indexname,index_settings, dopey_index_settings)]
     """
+    if inventory is not None:
+        opened = []
+        for e in indices:
+            index = inventory.get(e[0])
+            if index is not None and index['status'] == 'close':
+                logging.info(u"%s is closed, skip forcemerge" % e[0])
+                continue
+            opened.append(e)
+        indices = opened
+    if not indices:
+        return []
+
+    segments = collections.defaultdict(int)
+    for row in _cat(config, 'segments', sorted(set(e[0] for e in indices)), 'index,shard,prirep,id',
+                    {"ignore_unavailable": "true"}):
+        segments[(row['index'], row.get('shard'), row.get('prirep'), row.get('id'))] += 1
+    max_segments = {}
+    for (indexname, _, _, _), count in segments.items():
+        max_segments[indexname] = max(max_segments.get(indexname, 0), count)
+
     rst = []
     for index, index_settings, dopey_index_settings in indices:
-        if_same = _compare_index_settings(dopey_index_settings, index_settings)
-        if if_same is True:
+        dopey_index_settings = dopey_index_settings or {}
+        max_num_segments = int(dopey_index_settings.get("max_num_segments", 1))
+        if index not in max_segments:
+            # failed request, or a closed or missing index. let forcemerge tell
+            logging.debug(u"%s has no segments listed, forcemerge it" % index)
+        elif (max_segments[index] <= max_num_segments and
+                str(dopey_index_settings.get("only_expunge_deletes")).lower() != 'true'):
+            logging.info(
+                u"%s has at most %d segments per shard, skip forcemerge" % (index, max_segments[index]))
+            continue
+        rst.append((index, index_settings, dopey_index_settings))
+    return rst
+
+
+def find_need_to_update_indices(indices):
+    """
+    :type indices: [(indexname,index_settings, dopey_index_settings)]
+    :rtype : [(indexname,index_settings, settings_delta)]
+    settings_delta is {dotted_key: value} of only the keys that differ
+    """
+    rst = []
+    # settings blocks are shared by all the indices of one config entry, flatten each once
+    flat_dopey_settings = {}
+    for index, index_settings, dopey_index_settings in indices:
+        if id(dopey_index_settings) not in flat_dopey_settings:
+            flat_dopey_settings[id(dopey_index_settings)] = _flatten_index_settings(dopey_index_settings)
+        diff = _diff_index_settings(
+            flat_dopey_settings[id(dopey_index_settings)], _flatten_index_settings(index_settings))
+        if not diff:
             logging.info(u"%s settings is unchanged , skip" % index)
             continue
         else:
             logging.info(
                 u"%s settings need to be updated. %s" % (index,
-                                                         json.dumps(if_same)))
-            rst.append((index, index_settings, dopey_index_settings))
+                                                         json.dumps(diff)))
+            rst.append((index, index_settings, dict((k, v[0]) for k, v in diff.items())))
 
     return rst
 
 
+def _freeze_settings(settings):
+    """
+    canonical and hashable form of settings, equal settings get equal fingerprints
+    >>> _freeze_settings({"b": {"c": "1"}, "a": [1, 2]}) == _freeze_settings({"a": [1, 2], "b": {"c": "1"}})
+    True
+    >>> _freeze_settings(None) == _freeze_settings({})
+    False
+    """
+    if isinstance(settings, dict):
+        return tuple(sorted((k, _freeze_settings(v)) for k, v in settings.items()))
+    if isinstance(settings, list):
+        return ('__list__',) + tuple(_freeze_settings(e) for e in settings)
+    return settings
+
+
 def arrange_indices_by_settings(indices):
     """
+    group indices by the fingerprint of dopey_index_settings, in the order groups first appear
     :type indices: [(indexname,index_settings, dopey_index_settings)]
     :rtype: [(dopey_index_settings,[indexname])]
     """
-    rst = []
+    rst = collections.OrderedDict()
     for index, index_settings, dopey_index_settings in indices:
-        for e in rst:
-            if dopey_index_settings == e[0]:
-                e[1].append(index)
-                break
-        else:
-            rst.append((dopey_index_settings, [index]))
+        fingerprint = _freeze_settings(dopey_index_settings)
+        if fingerprint not in rst:
+            rst[fingerprint] = (dopey_index_settings, [])
+        rst[fingerprint][1].append(index)
 
-    return rst
+    return rst.values()
 
 
-def update_settings_same_settings(config, indices, dopey_index_settings):
+def update_settings_same_settings(config, indices, dopey_index_settings, inventory=None):
     """
     :type indices: [indexname]
-    :rtype: None
+    :type inventory: {indexname: index record}
+    :rtype: [([indexname], ok)]
     """
-    retry = config.get('retry', 3)
-    batch = config.get('batch', 50)
-    while indices:
-        to_update_indices = indices[:batch]
-        to_update_indices_joined = ','.join(to_update_indices)
-
-        url = u"{}/{}/_settings".format(
-            config["eshost"], to_update_indices_joined)
-        logging.debug(u"update settings: %s", url)
-
-        for _ in range(retry):
-            try:
-                r = requests.put(
-                    url,
-                    timeout=300,
-                    params={
-                        "master_timeout": "10m",
-                        "ignore_unavailable": 'true'},
-                    data=json.dumps(dopey_index_settings), headers={"content-type": "application/json"})
+    return execute_action(
+        config, 'update_settings', [(dopey_index_settings, indices)], inventory)
 
-                if r.ok:
-                    logging.info(u"%s updated" % to_update_indices_joined)
-                    break
-                else:
-                    logging.warn(
-                        u"%s updated failed. %s" %
-                        (to_update_indices_joined, r.text))
-            except BaseException as e:
-                logging.info(e)
 
-        indices = indices[batch:]
-
-
-def update_settings(config, indices):
+def update_settings(config, indices, inventory=None):
     """
     :type indices: [(indexname,index_settings, dopey_index_settings)]
-    :rtype: None
+    :type inventory: {indexname: index record}
+    :rtype: [([indexname], ok)]
     """
     if not indices:
-        return
+        return []
 
     logging.debug(u"try to update index settings %s" %
                   ','.join([e[0] for e in indices]))
+    return execute_action(
+        config, 'update_settings',
+        prepare_action(config, 'update_settings', indices, inventory), inventory)
+
+
+def _cat(config, api, indices, columns, params=None):
+    """
+    GET _cat/{api}/{indices} in json, `settings_batch` indices per request
+    rtype: [{column: value}], rows of failed requests are left out
+    """
+    params = dict(params or {}, format="json", h=columns)
+    client = get_es_client(config['eshost'])
+    batcher = Batcher(
+        config.get('settings_batch', 100),
+        max_path_bytes=_get_max_path_bytes(config, params))
+    rst = []
+    for to_cat_indices in batcher.split(indices):
+        path = u"_cat/{}/{}".format(api, ','.join(to_cat_indices))
+        try:
+            r = client.get(path, params=params)
+            if not r.ok:
+                raise Exception(r.text)
+            rst.extend(r.json())
+        except Exception as e:
+            logging.error(u"could not get {}: {}".format(client.url(path), e))
+    return rst
+
+
+def _get_segments_count(config, indices):
+    """
+    rtype: {indexname: segments count of all the shards}
+    """
+    rst = {}
+    for row in _cat(config, 'indices', indices, 'index,sc'):
+        if row.get('sc') is not None:
+            rst[row['index']] = int(row['sc'])
+    return rst
+
 
-    need_to_update_indices = find_need_to_update_indices(indices)
-    logging.debug(u"need_to_update_indices: %s", need_to_update_indices)
+# node of the forcemerges of indices with no node known
+_UNKNOWN_NODE = None
+
+
+def _get_merge_nodes(index_nodes, indexname):
+    """
+    nodes a forcemerge of the index counts to. indices with no node known, as _cat/shards
+    failed or their shards are unassigned, share one unknown node, so they are capped too
+    type index_nodes: {indexname: set(node)}
+    >>> _get_merge_nodes({"a": set(["n1"])}, "a")
+    set(['n1'])
+    >>> _get_merge_nodes({"a": set()}, "a") == _get_merge_nodes({}, "b") == (_UNKNOWN_NODE,)
+    True
+    """
+    return index_nodes.get(indexname) or (_UNKNOWN_NODE,)
 
-    to_update_indices = arrange_indices_by_settings(need_to_update_indices)
-    logging.debug(u"to_update_indices: %s", to_update_indices)
 
-    for dopey_index_settings, indices in to_update_indices:
-        update_settings_same_settings(
-            config, indices, dopey_index_settings)
+def _poll_task(client, task):
+    """
+    rtype: None if the task is still running, else True if it succeeded.
+    raises if the task could not be got
+    """
+    r = client.get(u"_tasks/{}".format(task))
+    if r.status_code == 404:
+        logging.warn(u"task {} not found. {}".format(task, r.text))
+        return False
+    if not r.ok:
+        raise Exception(r.text)
+    status = r.json()
+    if not status.get('completed'):
+        return None
+    if status.get('error') or (status.get('response') or {}).get('_shards', {}).get('failed'):
+        logging.warn(u"task {} failed. {}".format(task, json.dumps(status)))
+        return False
+    return True
 
 
-def optimize_indices(config, indices):
+def _optimize_indices_async(config, to_optimize_indices, inventory=None, journal=None, tasks=None):
+    """
+    submit forcemerges as background tasks and poll _tasks until they complete.
+    an index is not submitted while any node holding its shards already runs
+    `max_merges_per_node` merges started by dopey. indices with no node known
+    run at most `max_merges_per_node` merges in total
+    :type to_optimize_indices: [(indexname, forcemerge_params)]
+    :type inventory: {indexname: index record}
+    :type journal: Journal, tasks submitted and indices done are written to it
+    :type tasks: {indexname: task}, already submitted tasks to poll instead of submitting again
+    :rtype: [([indexname], ok)], [(indexname, seconds, segments_before, segments_after)]
+    """
+    options = config.get('forcemerge') or {}
+    max_merges_per_node = max(1, int(options.get('max_merges_per_node', 1)))
+    poll_interval = float(options.get('poll_interval', 10))
+    max_poll_errors = max(1, int(options.get('max_poll_errors', 30)))
+    retry = int(_get_action_option(config, 'retry', 'optimize_indices', 1))
+    client = get_es_client(config['eshost'])
+    throttle = get_throttle(config)
+    indices = [e[0] for e in to_optimize_indices]
+
+    index_nodes = collections.defaultdict(set)
+    for row in _cat(config, 'shards', indices, 'index,node'):
+        if row.get('node'):
+            index_nodes[row['index']].add(row['node'])
+    if inventory is not None:
+        segments_before = dict((indexname, inventory[indexname]['segments_count'])
+                               for indexname in indices if indexname in inventory)
+    else:
+        segments_before = _get_segments_count(config, indices)
+
+    def submit(indexname, params):
+        path = u"{}/_forcemerge".format(indexname)
+        params = dict(params, wait_for_completion='false')
+        logging.debug(u"forcemerge: %s" % client.url(path))
+        r = request_with_retry(client, 'POST', path, retry, params=params)
+        if r is not None and r.ok:
+            return r.json()['task']
+        logging.warn(u"%s forcemerge failed. %s" % (
+            indexname, r.text if r is not None else u"no response"))
+
+    results = []
+    durations = {}
+    node_merges = collections.defaultdict(int)
+    # consecutive failed polls of every task
+    poll_errors = collections.defaultdict(int)
+    pending = []
+    running = {}
+    for e in to_optimize_indices:
+        indexname = e[0]
+        if tasks and indexname in tasks:
+            logging.info(u"%s forcemerge is polled as task %s" % (indexname, tasks[indexname]))
+            nodes = _get_merge_nodes(index_nodes, indexname)
+            for node in nodes:
+                node_merges[node] += 1
+            running[tasks[indexname]] = (indexname, nodes, time.time())
+        else:
+            pending.append(e)
+    while pending or running:
+        for e in list(pending):
+            indexname, params = e
+            nodes = _get_merge_nodes(index_nodes, indexname)
+            if any(node_merges[node] >= max_merges_per_node for node in nodes):
+                continue
+            if throttle is not None:
+                throttle.wait(1)
+            pending.remove(e)
+            task = submit(indexname, params)
+            if task is None:
+                results.append(([indexname], False))
+                if journal is not None:
+                    journal.done('optimize_indices', results[-1:])
+                continue
+            logging.info(u"%s forcemerge submitted as task %s" % (indexname, task))
+            if journal is not None:
+                journal.submitted(indexname, task)
+            for node in nodes:
+                node_merges[node] += 1
+            running[task] = (indexname, nodes, time.time())
+
+        if not running:
+            continue
+        time.sleep(poll_interval)
+        for task, (indexname, nodes, start) in running.items():
+            try:
+                ok = _poll_task(client, task)
+            except Exception as e:
+                poll_errors[task] += 1
+                logging.warn(u"could not get task {}: {}".format(task, e))
+                if poll_errors[task] < max_poll_errors:
+                    continue
+                logging.error(u"%s forcemerge is taken as failed after %d failed polls of task %s" % (
+                    indexname, poll_errors[task], task))
+                ok = False
+            else:
+                poll_errors.pop(task, None)
+                if ok is None:
+                    continue
+            del running[task]
+            for node in nodes:
+                node_merges[node] -= 1
+            durations[indexname] = time.time() - start
+            _record('latencies', durations[indexname])
+            if ok:
+                logging.info(u"%s forcemerged in %.1fs" % (indexname, durations[indexname]))
+            results.append(([indexname], ok))
+            if journal is not None:
+                journal.done('optimize_indices', results[-1:])
+
+    segments_after = _get_segments_count(config, sorted(durations))
+    stats = [(indexname, durations[indexname],
+              segments_before.get(indexname), segments_after.get(indexname))
+             for indexname in indices if indexname in durations]
+    return results, stats
+
+
+def optimize_indices(config, indices, stats=None, inventory=None):
     """
     :type indices: [(indexname,index_settings, dopey_index_settings)]
-    :rtype: None
-    """
-    arranged_indices = arrange_indices_by_settings(indices)
-
-    retry = config.get('retry', 1)
-    batch = config.get('batch', 50)
-
-    for dopey_index_settings, indices in arranged_indices:
-        if not dopey_index_settings:
-            dopey_index_settings = {}
-        dopey_index_settings.setdefault("max_num_segments", 1)
-        while indices:
-            to_optimize_indices = indices[:batch]
-            to_optimize_indices_joined = ','.join(to_optimize_indices)
-            url = u"{}/{}/_forcemerge".format(
-                config["eshost"], to_optimize_indices_joined)
-            logging.debug(u"forcemerge: %s" % url)
-
-            for _ in range(retry):
-                try:
-                    r = requests.post(url, headers={"content-type": "application/json"}, params=dopey_index_settings)
-                    if r.ok:
-                        logging.info(u"%s forcemerged" % to_optimize_indices_joined)
-                        break
-                    else:
-                        logging.warn(
-                            u"%s forcemerge failed. %s" %
-                            (to_optimize_indices_joined, r.text))
-                except BaseException as e:
-                    logging.info(e)
-
-            indices = indices[batch:]
+    :type inventory: {indexname: index record}
+    :type stats: list, [(indexname, seconds, segments_before, segments_after)] are appended to it in async mode
+    :rtype: [([indexname], ok)]
+    """
+    return execute_action(
+        config, 'optimize_indices',
+        prepare_action(config, 'optimize_indices', indices, inventory), inventory, stats)